@@ -37,38 +37,75 @@ Plays a random game of chess. Some abbreviations and terms:
 """
 
 from copy import deepcopy
+from array import array
+import json
+import multiprocessing
+import os
 import random
+import re
+import time
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def printReason(game_result):
+REASON_NAMES = {
+    0: "RUNNING",
     # Reason values
+    1: "INVALID_MOVE",
+    2: "INVALID_COLOR",
+    3: "INVALID_FROM_LOCATION",
+    4: "INVALID_TO_LOCATION",
+    5: "MUST_SET_PROMOTION",
+    6: "GAME_IS_OVER",
+    7: "AMBIGUOUS_MOVE",
+    # Result values
+    8: "WHITE_WIN",
+    9: "BLACK_WIN",
+    10: "STALEMATE",
+    11: "STASIS_COUNT_LIMIT_RULE",
+    12: "THREE_REPETITION_RULE",
+    }
+
+def printReason(game_result):
     if game_result == 0:
         #print("Running...")
         pass
-    elif game_result == 1:
-        print("INVALID_MOVE")
-    elif game_result == 2:
-        print("INVALID_COLOR")
-    elif game_result == 3:
-        print("INVALID_FROM_LOCATION")
-    elif game_result == 4:
-        print("INVALID_TO_LOCATION")
-    elif game_result == 5:
-        print("MUST_SET_PROMOTION")
-    elif game_result == 6:
-        print("GAME_IS_OVER")
-    elif game_result == 7:
-        print("AMBIGUOUS_MOVE")
-    # Result values
-    elif game_result == 8:
-        print("WHITE_WIN")
-    elif game_result == 9:
-        print("BLACK_WIN")
-    elif game_result == 10:
-        print("STALEMATE")
-    elif game_result == 11:
-        print("STASIS_COUNT_LIMIT_RULE")
-    elif game_result == 12:
-        print("THREE_REPETITION_RULE")
+    elif game_result in REASON_NAMES:
+        print(REASON_NAMES[game_result])
+
+# Zobrist keys: one random 64-bit number per piece and square, for black
+# to move, for each set of castling rights and for each ep file. A
+# position's key is the xor of the numbers that apply to it. They come
+# from their own generator so that they are the same in every run.
+zobrist_random = random.Random(20150101)
+ZOBRIST_PIECES = dict((p, [zobrist_random.getrandbits(64) for sq in range(64)])
+                      for p in "PNBRQKpnbrqk")
+ZOBRIST_BLACK = zobrist_random.getrandbits(64)
+ZOBRIST_CASTLE = [zobrist_random.getrandbits(64) for i in range(16)]
+ZOBRIST_EP = [zobrist_random.getrandbits(64) for i in range(8)]
+
+def zobristKey(board):
+    """
+    The Zobrist key of the pieces on board, a list of rows.
+    """
+    key = 0
+    for y in range(8):
+        row = board[y]
+        for x in range(8):
+            if row[x] != ' ':
+                key ^= ZOBRIST_PIECES[row[x]][y * 8 + x]
+    return key
+
+def castleBits(white_king, white_queen, black_king, black_queen):
+    """
+    Packs the four castling rights into a number from 0 to 15.
+    """
+    return ((white_king and 1) | (white_queen and 2) |
+            (black_king and 4) | (black_queen and 8))
+
+# Pieces by their 4-bit code in the history records, 0 is empty:
+PIECE_CODES = " PNBRQKpnbrqk"
 
 def makeRepr(state, board):
     b = ""
@@ -92,6 +129,9 @@ class State(object):
     """
     Container for move state.
     """
+    # plies between the snapshots that gotoMove can jump to
+    CHECKPOINT_INTERVAL = 32
+
     def __init__(self, player):
         self.game_result = 0 
         self.reason = 0
@@ -105,19 +145,28 @@ class State(object):
         self.ep = [0, 0]      
         self.stasis_count = 0
         self.move_count = 0
-        self.black_king_location = (0, 0)
-        self.white_king_location = (0, 0)
-        # three rep stack
-        self.three_rep_stack = []
-        # full state stack
-        self.state_stack = []
-        self.state_stack_pointer = 0
+        self.black_king_location = (4, 0)
+        self.white_king_location = (4, 7)
         # all moves, stored to make it easier to build textmoves
-        #[piece,from,to,takes,promotion,check/checkmate,specialmove]
-        #["KQRNBP",(fx,fy),(tx,ty),True/False,"QRNB"/None,"+#"/None,0-5]
-        self.cur_move = [None,None,None,False,None,None,0]
-        self.moves = []
+        #[piece,from,to,takes,promotion,check/checkmate,specialmove,
+        # SAN disambiguation (see ChessBoard.getDisambiguation)]
+        #["KQRNBP",(fx,fy),(tx,ty),True/False,"QRNB"/None,"+#"/None,0-5,0-3]
+        self.cur_move = [None,None,None,False,None,None,0,0]
         self.promotion_value = 1
+        # Zobrist key of the pieces, kept up to date by the ChessBoard
+        # as it moves them; see getKey for the whole position:
+        self.zobrist = INITIAL_ZOBRIST
+        # undo records for ChessBoard.push/pop, and the keys of the
+        # positions they reached
+        self.push_stack = []
+        self.push_keys = []
+        # The game history: one 64-bit record per halfmove (see
+        # pushState) and the key of every position from the start,
+        # with state_stack_pointer halfmoves played on the board.
+        # checkpoints holds a snapshot every CHECKPOINT_INTERVAL plies.
+        # repetitions counts the keys since the last irreversible
+        # move (pawn move or capture).
+        self.clearHistory()
 
     def setEP(self,epPos):
         self.ep[0], self.ep[1] = epPos
@@ -126,53 +175,214 @@ class State(object):
         self.ep[0] = 0
         self.ep[1] = 0
 
+    def getKey(self, player=None):
+        """
+        Returns the 64-bit Zobrist key of the current position: the
+        pieces, the player to move (by default state.player), castling
+        rights and en passant.
+        """
+        key = self.zobrist
+        if (player or self.player) == 'b':
+            key ^= ZOBRIST_BLACK
+        key ^= ZOBRIST_CASTLE[castleBits(self.white_king_castle,
+                                         self.white_queen_castle,
+                                         self.black_king_castle,
+                                         self.black_queen_castle)]
+        if self.ep[1]:
+            key ^= ZOBRIST_EP[self.ep[0]]
+        return key
+
     def threeRepetitions(self):
-        ts = self.three_rep_stack[:self.state_stack_pointer]
-        if not len(ts):
-            return False
-        last = ts[len(ts)-1]
-        if(ts.count(last) == 3):
-            return True
+        last = self.key_history[self.state_stack_pointer]
+        return self.repetitions.get(last, 0) >= 3
+
+    def indexRepetitions(self):
+        """
+        Recounts the positions since the last irreversible move, after
+        jumping around in the history.
+        """
+        end = self.state_stack_pointer + 1
+        start = max(0, end - 1 - self.stasis_count)
+        self.repetitions = {}
+        for key in self.key_history[start:end]:
+            self.repetitions[key] = self.repetitions.get(key, 0) + 1
+
+    def isRepeated(self):
+        """
+        Returns True if the position has been on the board before
+        since the last irreversible move, looking back through the
+        positions reached with ChessBoard.push and then the game
+        history. A search can score such a position as a draw.
+        """
+        keys = self.push_keys
+        pointer = self.state_stack_pointer
+        last = pointer + len(keys)
+        if keys:
+            key = keys[-1]
+        else:
+            key = self.key_history[pointer]
+        # only positions with the same player to move can be equal
+        ply = 2
+        while ply <= self.stasis_count and ply <= last:
+            index = last - ply
+            if index > pointer:
+                if keys[index - pointer - 1] == key:
+                    return True
+            elif self.key_history[index] == key:
+                return True
+            ply += 2
         return False
 
+    def countRepetition(self, key):
+        if self.stasis_count == 0:
+            self.repetitions = {}
+        self.repetitions[key] = self.repetitions.get(key, 0) + 1
+
     def endGame(self, reason):
         self.game_result = reason
+        if self.state_stack_pointer == len(self.history):
+            self.final_result = reason
+
+    def clearHistory(self):
+        """
+        Forgets all moves, making the current position the start of
+        the history.
+        """
+        self.history = array('Q')
+        key = self.getKey()
+        self.key_history = array('Q', [key])
+        self.checkpoints = []
+        self.state_stack_pointer = 0
+        self.final_result = 0
+        self.repetitions = {key: 1}
+
+    def pushState(self, board, undo):
+        """
+        Records the move just made on board, a list of rows. undo is
+        the ChessBoard undo record taken before the move.
+        """
+        if self.state_stack_pointer != len(self.history):
+            del self.history[self.state_stack_pointer:]
+            del self.key_history[self.state_stack_pointer + 1:]
+            del self.checkpoints[self.state_stack_pointer //
+                                 self.CHECKPOINT_INTERVAL:]
+            self.final_result = 0
+        fromPos, toPos, piece, captured = undo[:4]
+        castling, ep, stasis = undo[5:8]
+        fx, fy = fromPos
+        tx, ty = toPos
+        # bits 0-5 from square, 6-11 to square, 12-15 piece, 16-19
+        # captured piece, 20-23 promotion piece, 24-26 special move,
+        # 27-28 check, 29-32 castling rights before, 33-37 en passant
+        # before, 38-47 stasis count before, 48-51 castling rights
+        # after, 52-53 SAN disambiguation
+        record = ((fy * 8 + fx) |
+                  (ty * 8 + tx) << 6 |
+                  PIECE_CODES.index(piece) << 12 |
+                  PIECE_CODES.index(captured) << 16 |
+                  self.cur_move[6] << 24 |
+                  castleBits(*castling) << 29 |
+                  (ep[1] and (ep[1] - 2) << 3 | ep[0]) << 33 |
+                  min(stasis, 1023) << 38 |
+                  castleBits(self.white_king_castle,
+                             self.white_queen_castle,
+                             self.black_king_castle,
+                             self.black_queen_castle) << 48 |
+                  self.cur_move[7] << 52)
+        if self.cur_move[4]:
+            record |= PIECE_CODES.index(self.cur_move[4]) << 20
+        self.history.append(record)
+        # the player switch is still to come
+        if self.player == 'w':
+            player = 'b'
+        else:
+            player = 'w'
+        key = self.getKey(player)
+        self.key_history.append(key)
+        self.state_stack_pointer = len(self.history)
+        self.countRepetition(key)
+        if self.state_stack_pointer % self.CHECKPOINT_INTERVAL == 0:
+            self.checkpoints.append(
+                ("".join(["".join(row) for row in board]),
+                 castleBits(self.white_king_castle, self.white_queen_castle,
+                            self.black_king_castle, self.black_queen_castle),
+                 (self.ep[0], self.ep[1]), self.stasis_count, player,
+                 self.move_count + 1, self.zobrist))
+
+    def loadCheckpoint(self, board, index):
+        """
+        Sets board, a list of rows, and the state to the position of
+        checkpoint index, after (index + 1) * CHECKPOINT_INTERVAL plies.
+        Only the squares that differ are written.
+        """
+        (squares, castling, ep, stasis, player, move_count,
+         zobrist) = self.checkpoints[index]
+        for y in range(8):
+            row = board[y]
+            for x in range(8):
+                p = squares[y * 8 + x]
+                if row[x] != p:
+                    row[x] = p
+        sq = squares.find('K')
+        if sq >= 0:
+            self.white_king_location = (sq % 8, sq // 8)
+        sq = squares.find('k')
+        if sq >= 0:
+            self.black_king_location = (sq % 8, sq // 8)
+        self.setCastling(castling)
+        self.ep[0], self.ep[1] = ep
+        self.stasis_count = stasis
+        self.player = player
+        self.move_count = move_count
+        self.zobrist = zobrist
+        self.state_stack_pointer = (index + 1) * self.CHECKPOINT_INTERVAL
+        if self.state_stack_pointer == len(self.history):
+            self.game_result = self.final_result
+        else:
+            self.game_result = 0
+
+    def setCheck(self, check):
+        """
+        Marks the current move, and the last one in the history, as
+        giving check ("+") or mate ("#").
+        """
+        self.cur_move[5] = check
+        if self.state_stack_pointer:
+            i = self.state_stack_pointer - 1
+            self.history[i] = ((self.history[i] & ~(3 << 27)) |
+                               "+#".index(check) + 1 << 27)
+
+    def getMove(self, index):
+        """
+        Returns halfmove number index (counting from zero) in the
+        cur_move format.
+        """
+        record = self.history[index]
+        piece = PIECE_CODES[record >> 12 & 15]
+        special = record >> 24 & 7
+        promotion = record >> 20 & 15
+        return [piece.upper(),
+                (record & 7, record >> 3 & 7),
+                (record >> 6 & 7, record >> 9 & 7),
+                bool(record >> 16 & 15) or special == 2,
+                promotion and PIECE_CODES[promotion] or None,
+                [None, "+", "#"][record >> 27 & 3],
+                special,
+                record >> 52 & 3]
 
-    def pushState(self, board):
-        if self.state_stack_pointer != len(self.state_stack):
-            self.state_stack = self.state_stack[:self.state_stack_pointer]    
-            self.three_rep_stack =  self.three_rep_stack[:self.state_stack_pointer]
-            self.moves = self.moves[:self.state_stack_pointer-1]
-        three_state = [self.white_king_castle,
-                       self.white_queen_castle,
-                       self.black_king_castle,
-                       self.black_queen_castle,
-                       deepcopy(board),
-                       deepcopy(self.ep)]
-        self.three_rep_stack.append(three_state)
-        state_str = makeRepr(self, board)
-        self.state_stack.append(state_str)
-        self.state_stack_pointer = len(self.state_stack)            
-
-    def pushMove(self):
-        """
-        Push the current move onto the moves stack.
-        """
-        self.moves.append(deepcopy(self.cur_move))
-               
     def getMoveCount(self):
         """
         Returns the number of halfmoves in the stack. 
         Zero (0) means no moves has been made.
         """
-        return len(self.state_stack)-1
+        return len(self.history)
 
     def getCurrentMove(self):
         """
         Returns the current halfmove number. Zero (0) means before
         first move.
         """
-        return self.state_stack-1
+        return self.state_stack_pointer
 
     def setPromotion(self, promotion):
         """
@@ -189,7 +399,7 @@ class State(object):
         """
         return self.promotion_value
 
-    def getLastMoveType(self, board):
+    def getLastMoveType(self, board=None):
         """
         Returns a value that indicates if the last move was a "special
         move".  Returns -1 if no move has been done.  Return value can
@@ -201,13 +411,9 @@ class State(object):
         the king side.)  5=QUEEN_CASTLE_MOVE (Castling on the queen
         side.)
         """
-        if self.state_stack_pointer<=1: # No move has been done at thos pointer
+        if self.state_stack_pointer<=0: # No move has been done at thos pointer
             return -1
-        self.undo(board)
-        move = self.moves[self.state_stack_pointer-1]        
-        res = move[6]
-        self.redo(board)
-        return res
+        return self.history[self.state_stack_pointer-1] >> 24 & 7
 
     def getLastMove(self):
         """
@@ -218,93 +424,182 @@ class State(object):
         Ex. ((4, 6), (4, 4))
         Returns None if no moves has been made.
         """
-        if self.state_stack_pointer<=1: # No move has been done at thos pointer
+        if self.state_stack_pointer<=0: # No move has been done at thos pointer
             return None
-        self.undo(board)
-        move = self.moves[self.state_stack_pointer-1]        
-        res = (move[1], move[2])
-        self.redo(board)
-        return res
+        move = self.getMove(self.state_stack_pointer-1)
+        return (move[1], move[2])
 
     def getAllMoves(self, board, format=1):
         """
-        Returns a list of all moves done so far in Algebraic chess notation.
+        Returns a list of all moves done so far in Algebraic chess
+        notation, formatted by board, the ChessBoard.
         Returns None if no moves has been made.
         """
-        if self.state_stack_pointer<=1: # No move has been done at this pointer
+        if not self.history:
             return None
-        res = []
-        point = self.state_stack_pointer
-        self.gotoFirst(board)
-        while True:
-            move = self.moves[self.state_stack_pointer-1]  
-            res.append(self.formatTextMove(move, format))
-            if self.state_stack_pointer >= len(self.state_stack)-1:
-                break
-            self.redo(board)
-        self.state_stack_pointer = point
-        self.loadCurState(board)
-        return res
+        return [board.formatTextMove(self.getMove(i), format)
+                for i in range(len(self.history))]
 
     def getLastMove(self, board, format=1):
         """
-        Returns the latest move as Algebraic chess notation.
+        Returns the latest move as Algebraic chess notation, formatted
+        by board, the ChessBoard.
         Returns None if no moves has been made.
         """
-        if self.state_stack_pointer<=1: # No move has been done at that pointer
+        if self.state_stack_pointer<=0: # No move has been done at that pointer
             return None
-        self.undo(board)
-        move = self.moves[self.state_stack_pointer-1]        
-        res = self.formatTextMove(move, format)
-        self.redo(board)
-        return res
+        move = self.getMove(self.state_stack_pointer-1)
+        return board.formatTextMove(move, format)
          
     def gotoMove(self, board, move):
         """
         Goto the specified halfmove. Zero (0) is before the first move.
         Return False if move is out of range.
         """
-        move+=1
-        if move > len(self.state_stack):
+        if move > len(self.history):
             return False
-        if move < 1:
+        if move < 0:
             return False
-        self.state_stack_pointer = move
-        self.loadCurState(board)
-                          
-    def loadCurState(self, board):
-        s = self.state_stack[self.state_stack_pointer-1]
-        b= s[:64]
-        v = s[64:72]
-        f =  int(s[73:])
-        idx = 0
-        for r in range(8):
-            for c in range(8):
-                board[r][c]=b[idx]
-                idx+=1
-        self.player                = v[0]
-        self.white_king_castle     = int(v[1])
-        self.white_queen_castle    = int(v[2]) 
-        self.black_king_castle     = int(v[3])
-        self.black_queen_castle    = int(v[4])
-        self.ep[0]                 = int(v[5])
-        self.ep[1]                 = int(v[6])
-        self.game_result           = int(v[7])
-        self.stasis_count = f
+        # start from the nearest checkpoint if that is closer
+        n = self.CHECKPOINT_INTERVAL
+        distance = abs(move - self.state_stack_pointer)
+        index = None
+        for i in (move // n - 1, move // n):
+            if 0 <= i < len(self.checkpoints):
+                if abs(move - (i + 1) * n) < distance:
+                    index = i
+                    distance = abs(move - (i + 1) * n)
+        if index is not None:
+            self.loadCheckpoint(board, index)
+        while self.state_stack_pointer > move:
+            self.stepBack(board)
+        while self.state_stack_pointer < move:
+            self.stepForward(board)
+        self.indexRepetitions()
+        return True
+
+    def putSquare(self, board, x, y, p):
+        """
+        Puts p on (x, y) of board, a list of rows, keeping the Zobrist
+        key up to date.
+        """
+        old = board[y][x]
+        if old != ' ':
+            self.zobrist ^= ZOBRIST_PIECES[old][y * 8 + x]
+        if p != ' ':
+            self.zobrist ^= ZOBRIST_PIECES[p][y * 8 + x]
+        board[y][x] = p
+
+    def setCastling(self, bits):
+        self.white_king_castle = bool(bits & 1)
+        self.white_queen_castle = bool(bits & 2)
+        self.black_king_castle = bool(bits & 4)
+        self.black_queen_castle = bool(bits & 8)
+
+    def stepBack(self, board):
+        """
+        Takes back the halfmove before the pointer on board, a list of
+        rows, without any repetition bookkeeping.
+        """
+        self.state_stack_pointer -= 1
+        record = self.history[self.state_stack_pointer]
+        fx, fy = record & 7, record >> 3 & 7
+        tx, ty = record >> 6 & 7, record >> 9 & 7
+        piece = PIECE_CODES[record >> 12 & 15]
+        special = record >> 24 & 7
+        white = piece.isupper()
+        self.putSquare(board, tx, ty, PIECE_CODES[record >> 16 & 15])
+        self.putSquare(board, fx, fy, piece)
+        if special == 2:
+            self.putSquare(board, tx, fy, white and 'p' or 'P')
+        elif special == 4:
+            self.putSquare(board, 5, fy, ' ')
+            self.putSquare(board, 7, fy, white and 'R' or 'r')
+        elif special == 5:
+            self.putSquare(board, 3, fy, ' ')
+            self.putSquare(board, 0, fy, white and 'R' or 'r')
+        if piece == 'K':
+            self.white_king_location = (fx, fy)
+        elif piece == 'k':
+            self.black_king_location = (fx, fy)
+        self.setCastling(record >> 29 & 15)
+        ep = record >> 33 & 31
+        if ep:
+            self.setEP((ep & 7, (ep >> 3) + 2))
+        else:
+            self.clearEP()
+        self.stasis_count = record >> 38 & 1023
+        self.player = white and 'w' or 'b'
+        self.move_count -= 1
+        self.game_result = 0
+
+    def stepForward(self, board):
+        """
+        Replays the halfmove after the pointer on board, a list of
+        rows, without any repetition bookkeeping.
+        """
+        record = self.history[self.state_stack_pointer]
+        self.state_stack_pointer += 1
+        fx, fy = record & 7, record >> 3 & 7
+        tx, ty = record >> 6 & 7, record >> 9 & 7
+        piece = PIECE_CODES[record >> 12 & 15]
+        captured = record >> 16 & 15
+        promotion = record >> 20 & 15
+        special = record >> 24 & 7
+        white = piece.isupper()
+        self.putSquare(board, fx, fy, ' ')
+        self.putSquare(board, tx, ty, PIECE_CODES[promotion or
+                                                  record >> 12 & 15])
+        if special == 2:
+            self.putSquare(board, tx, fy, ' ')
+        elif special == 4:
+            self.putSquare(board, 7, fy, ' ')
+            self.putSquare(board, 5, fy, white and 'R' or 'r')
+        elif special == 5:
+            self.putSquare(board, 0, fy, ' ')
+            self.putSquare(board, 3, fy, white and 'R' or 'r')
+        if piece == 'K':
+            self.white_king_location = (tx, ty)
+        elif piece == 'k':
+            self.black_king_location = (tx, ty)
+        self.setCastling(record >> 48 & 15)
+        if special == 1:
+            self.setEP((tx, ty))
+        else:
+            self.clearEP()
+        if piece in 'Pp' or captured:
+            self.stasis_count = 0
+        else:
+            self.stasis_count = (record >> 38 & 1023) + 1
+        self.player = white and 'b' or 'w'
+        self.move_count += 1
+        if self.state_stack_pointer == len(self.history):
+            self.game_result = self.final_result
+        else:
+            self.game_result = 0
+
+    def setKingLocations(self, board):
+        """
+        Finds the kings on board, a list of rows.
+        """
+        for y in range(8):
+            for x in range(8):
+                if board[y][x] == 'K':
+                    self.white_king_location = (x, y)
+                elif board[y][x] == 'k':
+                    self.black_king_location = (x, y)
                         
     def gotoFirst(self, board):
         """
         Goto before the first known move.
         """
-        self.state_stack_pointer = 1
-        self.loadCurState(board)
+        self.gotoMove(board, 0)
 
     def gotoLast(self, board):
         """
         Goto after the last knwon move.
         """
-        self.state_stack_pointer = len(self.state_stack)
-        self.loadCurState(board)
+        self.gotoMove(board, len(self.history))
         
     def undo(self, board):
         """
@@ -312,10 +607,17 @@ class State(object):
         board setup.
         Returns True or False if no more moves can be undone.
         """
-        if self.state_stack_pointer <= 1:
+        if self.state_stack_pointer <= 0:
             return False
-        self.state_stack_pointer -= 1
-        self.loadCurState(board)
+        key = self.key_history[self.state_stack_pointer]
+        irreversible = self.stasis_count == 0
+        self.stepBack(board)
+        if irreversible:
+            self.indexRepetitions()
+        elif self.repetitions[key] == 1:
+            del self.repetitions[key]
+        else:
+            self.repetitions[key] -= 1
         return True
 
     def redo(self, board):
@@ -324,12 +626,29 @@ class State(object):
         method to step forward until the last move i reached.  Returns
         True or False if no more moves can be redone.
         """
-        if self.state_stack_pointer == len(self.state_stack):
+        if self.state_stack_pointer == len(self.history):
             return False
-        self.state_stack_pointer += 1
-        self.loadCurState(board)
+        self.stepForward(board)
+        self.countRepetition(self.key_history[self.state_stack_pointer])
         return True
 
+class TrackedRank(list):
+    """
+    One row of a board that tells its owner about every write, so
+    that ChessBoard.board can still be assigned to directly while the
+    owner keeps other representations of the position in step.
+    """
+    def __init__(self, owner, y, row):
+        list.__init__(self, row)
+        self.owner = owner
+        self.y = y
+
+    def __setitem__(self, x, p):
+        old = list.__getitem__(self, x)
+        list.__setitem__(self, x, p)
+        self.owner.board_version += 1
+        self.owner.squareChanged(x, self.y, old, p)
+
 class ChessBoard(object):
     """
     The class that holds the board and values.
@@ -364,8 +683,28 @@ class ChessBoard(object):
     AN = 0      # g4-e3
     SAN = 1     # Bxe3
     LAN = 2     # Bg4xe3
+    # Evaluation table kept up to date by squareChanged, if any, and
+    # the score it gives the position (see setEvalTable)
+    eval_table = None
+    eval_score = 0
+    # Counts the writes to the board, so that caches of what was
+    # worked out from it can tell when it has changed
+    board_version = 0
+    # Piece values, in pawns, of the static exchange evaluation
+    EXCHANGE_VALUES = {'P': 1, 'N': 3, 'B': 3, 'R': 5, 'Q': 9, 'K': 100}
+
+    def __new__(cls, backend=None):
+        """
+        Pick the board representation. backend can be "list" (the
+        default, an 8 x 8 list of characters) or "bitboard".
+        """
+        if backend is not None:
+            if backend not in BACKENDS:
+                raise ValueError("unknown backend: '%s'" % backend)
+            cls = BACKENDS[backend]
+        return object.__new__(cls)
 
-    def __init__(self):
+    def __init__(self, backend=None):
         self.resetBoard()
 
     def __repr__(self):
@@ -400,12 +739,18 @@ class ChessBoard(object):
         kx, ky = self.getKingLocation(state)
         fx, fy = fromPos
         done = False
+        # the board is put back as it was, so these writes should not
+        # count as changes
+        version = self.board_version
         fp = self.board[fy][fx]
         self.board[fy][fx] = " "
         if not self.isThreatened(state, kx, ky):
             done = True
         self.board[fy][fx] = fp
-        if done:
+        self.board_version = version
+        # an en passant capture also takes the captured pawn off the
+        # row, which can open a line to the king:
+        if done and self.EP_CAPTURE_MOVE not in specialMoves.values():
             return moves
         for m in moves:
             tx, ty = m
@@ -424,8 +769,21 @@ class ChessBoard(object):
                 self.board[state.ep[1]][state.ep[0]] = sp
             self.board[fy][fx] = fp
             self.board[ty][tx] = tp
+        self.board_version = version
         return result    
        
+    def putPiece(self, state, x, y, p):
+        """
+        Puts piece p (or ' ') on the board at x, y, keeping the
+        state's Zobrist key in step.
+        """
+        old = self.board[y][x]
+        if old != ' ':
+            state.zobrist ^= ZOBRIST_PIECES[old][y * 8 + x]
+        if p != ' ':
+            state.zobrist ^= ZOBRIST_PIECES[p][y * 8 + x]
+        self.board[y][x] = p
+
     def isFree(self, x, y):
         """
         Is this spot on the board open?
@@ -495,15 +853,47 @@ class ChessBoard(object):
 
     def hasAnyValidMoves(self, state):
         """
-        Does the state.player have any valid moves?
+        Does the state.player have any valid moves? Stops at the first
+        piece that has one, trying the king first. What it works out is
+        kept for getMoves.
         """
-        for y in range(0, 8):
-            for x in range(0, 8):
-                if self.getColor(x, y) == state.player:
-                    if len(self.getValidMoves(state, (x, y))):
-                        return True
+        if state.game_result:
+            return False
+        cache = self.getMoveCache(state)
+        if self.move_list is not None:
+            return len(self.move_list) > 0
+        king = self.getKingLocation(state)
+        locations = self.getPieces(state.player)
+        if king in locations:
+            locations.remove(king)
+            locations.insert(0, king)
+        for location in locations:
+            if location not in cache:
+                cache[location] = self.getMoveFrom(state, location)
+            if cache[location]:
+                return True
         return False
 
+    def getMoveCache(self, state):
+        """
+        Returns the legal moves already worked out for this position,
+        a dictionary from location to moves, and starts over when the
+        position (State.getKey()) or the board (board_version, which
+        also catches squares assigned to directly) has changed.
+        move_list is the whole getMoves list, once it is known.
+        """
+        key = (state.getKey(), self.board_version)
+        if key != self.move_cache_key:
+            self.move_cache_key = key
+            self.move_cache = {}
+            self.move_list = None
+        return self.move_cache
+
+    def clearMoveCache(self):
+        self.move_cache_key = None
+        self.move_cache = {}
+        self.move_list = None
+
     #-----------------------------------------------------------------
     def traceValidMoves(self, state, fromPos, dirs, maxSteps=8):
         """
@@ -627,22 +1017,27 @@ class ChessBoard(object):
             c_king = state.white_king_castle
             c_queen = state.white_queen_castle
             k = "K"
+            r = "R"
         else:
             c_row = 0
             c_king = state.black_king_castle
             c_queen = state.black_queen_castle
             k = "k"
+            r = "r"
         dirs = [(1, 0), (-1, 0), (0, 1), (0, -1), 
                 (1, 1), (-1, 1), (1, -1), (-1, -1) ]
         t_moves = self.traceValidMoves(state, fromPos, dirs, 1)
         moves = []
+        # the king is lifted off the board while its squares are
+        # tested, and put back, which is not a change of the board
+        version = self.board_version
         self.board[fromPos[1]][fromPos[0]] = ' '
         for m in t_moves:
             if not self.isThreatened(state, m[0], m[1]):
                 moves.append(m)
         if c_king: 
             if (self.isFree(5, c_row) and self.isFree(6, c_row) and 
-                self.board[c_row][7].upper() == 'R'):   
+                self.board[c_row][7] == r):   
                 if (not self.isThreatened(state, 4, c_row) and 
                     not self.isThreatened(state, 5, c_row) and 
                     not self.isThreatened(state, 6, c_row)):   
@@ -650,13 +1045,14 @@ class ChessBoard(object):
                     specialMoves[(6, c_row)] = self.KING_CASTLE_MOVE
         if c_queen: 
             if (self.isFree(3, c_row) and self.isFree(2, c_row) and 
-                self.isFree(1, c_row) and self.board[c_row][0].upper() == 'R'): 
+                self.isFree(1, c_row) and self.board[c_row][0] == r): 
                 if (not self.isThreatened(state, 4, c_row) and 
                     not self.isThreatened(state, 3, c_row) and 
                     not self.isThreatened(state, 2, c_row)): 
                     moves.append((2, c_row))
                     specialMoves[(2, c_row)] = self.QUEEN_CASTLE_MOVE
         self.board[fromPos[1]][fromPos[0]] = k
+        self.board_version = version
         return (moves, specialMoves)        
 
     # -----------------------------------------------------
@@ -669,7 +1065,7 @@ class ChessBoard(object):
         else:
             t = 0
         if t == self.EP_CAPTURE_MOVE:
-            self.board[state.ep[1]][state.ep[0]] = ' '
+            self.putPiece(state, state.ep[0], state.ep[1], ' ')
             state.cur_move[3]=True
             state.cur_move[6]=self.EP_CAPTURE_MOVE
         pv = state.promotion_value
@@ -700,8 +1096,8 @@ class ChessBoard(object):
             state.clearEP()
         if self.board[toPos[1]][toPos[0]] != ' ':
             state.cur_move[3]=True
-        self.board[toPos[1]][toPos[0]] = p
-        self.board[fromPos[1]][fromPos[0]] = " "
+        self.putPiece(state, toPos[0], toPos[1], p)
+        self.putPiece(state, fromPos[0], fromPos[1], " ")
         state.stasis_count = 0
         return True
 
@@ -715,8 +1111,9 @@ class ChessBoard(object):
         else:
             state.stasis_count=0
             state.cur_move[3]=True
-        self.board[toPos[1]][toPos[0]] = self.board[fromPos[1]][fromPos[0]]
-        self.board[fromPos[1]][fromPos[0]] = " "     
+        self.putPiece(state, toPos[0], toPos[1],
+                      self.board[fromPos[1]][fromPos[0]])
+        self.putPiece(state, fromPos[0], fromPos[1], " ")
         return True
 
     def moveKing(self, state, fromPos, toPos):
@@ -744,17 +1141,17 @@ class ChessBoard(object):
             state.black_queen_castle = False
         if t == self.KING_CASTLE_MOVE:
             state.stasis_count+=1
-            self.board[c_row][4] = " "
-            self.board[c_row][6] = k     
-            self.board[c_row][7] = " "
-            self.board[c_row][5] = r
+            self.putPiece(state, 4, c_row, " ")
+            self.putPiece(state, 6, c_row, k)
+            self.putPiece(state, 7, c_row, " ")
+            self.putPiece(state, 5, c_row, r)
             state.cur_move[6] = self.KING_CASTLE_MOVE
         elif t == self.QUEEN_CASTLE_MOVE:
             state.stasis_count+=1
-            self.board[c_row][4] = " "
-            self.board[c_row][2] = k
-            self.board[c_row][0] = " "
-            self.board[c_row][3] = r     
+            self.putPiece(state, 4, c_row, " ")
+            self.putPiece(state, 2, c_row, k)
+            self.putPiece(state, 0, c_row, " ")
+            self.putPiece(state, 3, c_row, r)
             state.cur_move[6] = self.QUEEN_CASTLE_MOVE
         else:                      
             if self.board[toPos[1]][toPos[0]] == " ":     
@@ -762,8 +1159,13 @@ class ChessBoard(object):
             else:
                 state.stasis_count=0
                 state.cur_move[3]=True
-            self.board[toPos[1]][toPos[0]] = self.board[fromPos[1]][fromPos[0]]
-            self.board[fromPos[1]][fromPos[0]] = " "
+            self.putPiece(state, toPos[0], toPos[1],
+                          self.board[fromPos[1]][fromPos[0]])
+            self.putPiece(state, fromPos[0], fromPos[1], " ")
+        if state.player == 'w':
+            state.white_king_location = tuple(toPos)
+        else:
+            state.black_king_location = tuple(toPos)
         return True
 
     def moveQueen(self, state, fromPos, toPos):
@@ -776,8 +1178,9 @@ class ChessBoard(object):
         else:
             state.stasis_count=0
             state.cur_move[3]=True
-        self.board[toPos[1]][toPos[0]] = self.board[fromPos[1]][fromPos[0]]
-        self.board[fromPos[1]][fromPos[0]] = " "     
+        self.putPiece(state, toPos[0], toPos[1],
+                      self.board[fromPos[1]][fromPos[0]])
+        self.putPiece(state, fromPos[0], fromPos[1], " ")
         return True
 
     def moveBishop(self, state, fromPos, toPos):
@@ -790,8 +1193,9 @@ class ChessBoard(object):
         else:
             state.stasis_count=0
             state.cur_move[3]=True
-        self.board[toPos[1]][toPos[0]] = self.board[fromPos[1]][fromPos[0]]
-        self.board[fromPos[1]][fromPos[0]] = " "     
+        self.putPiece(state, toPos[0], toPos[1],
+                      self.board[fromPos[1]][fromPos[0]])
+        self.putPiece(state, fromPos[0], fromPos[1], " ")
         return True
 
     def moveRook(self, state, fromPos, toPos):
@@ -815,8 +1219,9 @@ class ChessBoard(object):
         else:
             state.stasis_count=0
             state.cur_move[3]=True
-        self.board[toPos[1]][toPos[0]] = self.board[fromPos[1]][fromPos[0]]
-        self.board[fromPos[1]][fromPos[0]] = " "     
+        self.putPiece(state, toPos[0], toPos[1],
+                      self.board[fromPos[1]][fromPos[0]])
+        self.putPiece(state, fromPos[0], fromPos[1], " ")
         return True
 
     def parseTextMove(self, state, txt):
@@ -879,12 +1284,61 @@ class ChessBoard(object):
             h_piece = None
         return (h_piece, h_file, h_rank, dest_x, dest_y, promotion)
 
-    def formatTextMove(self, move, format):
+    def resolveTextMove(self, state, txt):
+        """
+        Finds the legal move that a text move (see parseTextMove)
+        stands for. Check marks and annotations like "+" or "!?" are
+        ignored. Returns (fromPos, toPos, promotion), or None with
+        state.reason set if there is no such move, or more than one.
+        """
+        txt = txt.strip().rstrip("+#!?").replace("0", "O")
+        hint = self.parseTextMove(state, txt)
+        if hint is None:
+            state.reason = self.INVALID_MOVE
+            return None
+        h_piece, h_file, h_rank, dest_x, dest_y, promotion = hint
+        found = []
+        for fromPos, piece, toList in self.getMoves(state):
+            if (dest_x, dest_y) not in toList:
+                continue
+            if h_piece is not None and piece.upper() != h_piece:
+                continue
+            if h_file > -1 and fromPos[0] != h_file:
+                continue
+            if h_rank > -1 and fromPos[1] != h_rank:
+                continue
+            found.append(fromPos)
+        if not found:
+            state.reason = self.INVALID_MOVE
+            return None
+        if len(found) > 1:
+            state.reason = self.AMBIGUOUS_MOVE
+            return None
+        return found[0], (dest_x, dest_y), promotion
+
+    def addTextMove(self, state, txt):
+        """
+        Makes a move given as text, in any of the formats that
+        parseTextMove reads, like makeMove does. A promotion without a
+        piece promotes to a queen. Returns True if that was a valid
+        move; if not, state.reason tells why.
+        """
+        move = self.resolveTextMove(state, txt)
+        if move is None:
+            return False
+        fromPos, toPos, promotion = move
+        state.setPromotion(promotion or self.QUEEN)
+        return self.makeMove(state, fromPos, toPos)
+
+    def formatTextMove(self, move, format, state=None):
         """
         Creates standard chess text format from a move, and a format code
         (AN, LAN, or SAN).
-        A move is "piece fromPos toPos take promotion check special"
-        Format can be in AN, LAN, or SAN.
+        A move is "piece fromPos toPos take promotion check special
+        disambiguation", the last being optional (see
+        State.getMove()). Format can be in AN, LAN, or SAN. For SAN
+        without disambiguation, state must be the position before the
+        move, if it is to be worked out.
         """
         #piece, from, to, take, promotion, check, special
         piece = move[0]       # char code
@@ -919,43 +1373,103 @@ class ChessBoard(object):
                                         pt, check)
         elif format == self.SAN:
             if special == self.KING_CASTLE_MOVE:
-                return "O-O"
+                return "O-O" + (check or "")
             elif special == self.QUEEN_CASTLE_MOVE:
-                return "O-O-O"
-            tc = ""
-            if take:
-                tc = "x"
-            pt = ""
-            if promo:
-                pt = "=%s" % promo.upper()
-            p = piece
-            if state.player == 'b':
-                p = p.lower()
+                return "O-O-O" + (check or "")
+            if len(move) > 7:
+                hint = move[7]
+            elif state is not None:
+                hint = self.getDisambiguation(state, fpos, tpos)
+            else:
+                hint = 0
             if piece == "P":
                 piece = ""
-            if not check:
-                check = ""
-            fx, fy = fpos
-            hint_f = ""
-            hint_r = ""
-            for y in range(8):
-                for x in range(8):                    
-                    if self.board[y][x] == p:
-                        if x == fx and y == fy:
-                            continue
-                        vm = self.getValidMoves(state, (x, y))
-                        if tpos in vm:
-                            if fx == x:
-                                hint_r = ranks[fy]
-                            else:
-                                hint_f = files[fx]
-            if piece == "" and take:
-                hint_f = files[fx]
-            res = "%s%s%s%s%s%s%s%s" % (piece, hint_f, hint_r, tc, 
-                                        files[tpos[0]], ranks[tpos[1]], 
-                                        pt, check)
+                if take:
+                    hint = 1
+            res = piece
+            if hint & 1:
+                res += files[fpos[0]]
+            if hint & 2:
+                res += ranks[fpos[1]]
+            if take:
+                res += "x"
+            res += files[tpos[0]] + ranks[tpos[1]]
+            if promo:
+                res += "=" + promo.upper()
+            if check:
+                res += check
         return res
 
+    def getDisambiguation(self, state, fromPos, toPos):
+        """
+        Returns what the SAN of the move from fromPos to toPos needs,
+        besides the piece letter, to tell it from the other legal
+        moves of the same kind of piece to toPos: 0 nothing, 1 the
+        file, 2 the rank, 3 both. Uses the moves getMoves already
+        worked out for the position, if any; otherwise only the other
+        pieces of the kind that could reach toPos get their moves
+        worked out (and kept in the move cache).
+        """
+        fromPos = tuple(fromPos)
+        toPos = tuple(toPos)
+        piece = self.board[fromPos[1]][fromPos[0]]
+        if piece in ' PpKk':
+            return 0
+        cache = self.getMoveCache(state)
+        others = []
+        if self.move_list is not None:
+            for location, p, toList in self.move_list:
+                if p == piece and location != fromPos and toPos in toList:
+                    others.append(location)
+        else:
+            for location in self.getPieces(state.player):
+                x, y = location
+                if (self.board[y][x] != piece or location == fromPos or
+                    not self.canReach(location, toPos)):
+                    continue
+                if location not in cache:
+                    cache[location] = self.getMoveFrom(state, location)
+                if toPos in cache[location]:
+                    others.append(location)
+        if not others:
+            return 0
+        same_file = same_rank = False
+        for location in others:
+            same_file = same_file or location[0] == fromPos[0]
+            same_rank = same_rank or location[1] == fromPos[1]
+        if same_file and same_rank:
+            return 3
+        if same_file:
+            return 2
+        return 1
+
+    def canReach(self, fromPos, toPos):
+        """
+        Could the knight, bishop, rook or queen on fromPos move to
+        toPos on an otherwise empty path, leaving checks aside?
+        """
+        fx, fy = fromPos
+        tx, ty = toPos
+        dx, dy = tx - fx, ty - fy
+        p = self.board[fy][fx].upper()
+        if p == 'N':
+            return (abs(dx), abs(dy)) in ((1, 2), (2, 1))
+        if (dx == 0 and dy == 0) or (dx and dy and abs(dx) != abs(dy)):
+            return False
+        if p == 'R' and dx and dy:
+            return False
+        if p == 'B' and not (dx and dy):
+            return False
+        sx = (dx > 0) - (dx < 0)
+        sy = (dy > 0) - (dy < 0)
+        x, y = fx + sx, fy + sy
+        while (x, y) != (tx, ty):
+            if self.board[y][x] != ' ':
+                return False
+            x += sx
+            y += sy
+        return True
+
     def getValidMoves(self, state, location):
         """
         Returns a list of valid moves. (ex [ [3, 4], [3, 5], [3, 6]
@@ -994,14 +1508,28 @@ class ChessBoard(object):
     #-----------------------------------------------------------------------
     
     def getMoves(self, state):
-        retval = []
-        for y in range(0, 8):
-            for x in range(0, 8):
-                if self.getColor(x, y) == state.player:
+        cache = self.getMoveCache(state)
+        if self.move_list is None:
+            retval = []
+            for x, y in self.getPieces(state.player):
+                if (x, y) in cache:
+                    moves = cache[(x, y)]
+                else:
                     moves = self.getMoveFrom(state, (x, y))
-                    if moves:
-                        retval.append(((x,y), self.board[y][x], moves))
-        return retval
+                    cache[(x, y)] = moves
+                if moves:
+                    retval.append(((x,y), self.board[y][x], moves))
+            self.move_list = retval
+        return self.copyMoves(self.move_list)
+
+    def copyMoves(self, move_list):
+        """
+        Returns a copy of move_list, down to the lists of targets, so
+        that what getMoves hands out can be changed without changing
+        the move cache.
+        """
+        return [(location, p, list(moves))
+                for location, p, moves in move_list]
              
     def getMoveFrom(self, state, location):
         """
@@ -1037,7 +1565,7 @@ class ChessBoard(object):
         """
         Resets the chess board and all states.
         """
-        self.board = [
+        self.setBoard([
             ['r', 'n', 'b', 'q', 'k', 'b', 'n', 'r'], 
             ['p']*8, 
             [' ']*8, 
@@ -1046,15 +1574,289 @@ class ChessBoard(object):
             [' ']*8, 
             ['P']*8, 
             ['R', 'N', 'B', 'Q', 'K', 'B', 'N', 'R']
-            ]
+            ])
+
+    def setBoard(self, rows):
+        """
+        Sets the board up from eight rows of piece characters. Use this
+        (or assign to single squares) rather than replacing the board
+        attribute, so that the piece lists stay right.
+        """
+        self.startTracking()
+        self.clearMoveCache()
+        self.eval_score = 0
+        self.board = [TrackedRank(self, y, [' '] * 8) for y in range(8)]
+        for y in range(8):
+            for x in range(8):
+                if rows[y][x] != ' ':
+                    self.board[y][x] = rows[y][x]
+
+    def setFEN(self, state, fen):
+        """
+        Sets the board and state up from a FEN string: the pieces,
+        player, castling rights, en passant square, halfmove clock and
+        move number (the last two may be left out). The state history
+        starts over at the new position. Raises ValueError for a
+        malformed FEN, one without exactly one king of each color, or
+        with an en passant square on the wrong side for the player.
+        Castling rights whose king or rook is not on its square are
+        left out.
+        """
+        fields = fen.split()
+        if not 4 <= len(fields) <= 6 or fields[1] not in ('w', 'b'):
+            raise ValueError("invalid FEN: '%s'" % fen)
+        ranks = fields[0].split("/")
+        if len(ranks) != 8:
+            raise ValueError("invalid FEN: '%s'" % fen)
+        rows = []
+        for rank in ranks:
+            row = []
+            for ch in rank:
+                if ch in "12345678":
+                    row.extend([' '] * int(ch))
+                elif ch in "PNBRQKpnbrqk":
+                    row.append(ch)
+                else:
+                    raise ValueError("invalid FEN: '%s'" % fen)
+            if len(row) != 8:
+                raise ValueError("invalid FEN: '%s'" % fen)
+            rows.append(row)
+        for king in "Kk":
+            if sum(row.count(king) for row in rows) != 1:
+                raise ValueError("invalid FEN, needs one '%s': '%s'" %
+                                 (king, fen))
+        castling = fields[2]
+        ep = fields[3]
+        if castling != '-' and (castling.strip("KQkq") or
+                                len(set(castling)) != len(castling)):
+            raise ValueError("invalid FEN: '%s'" % fen)
+        # drop the rights whose king or rook is not on its square, so
+        # that each position has one FEN and one key
+        rights = ""
+        for right, y, king, rook, x in (('K', 7, 'K', 'R', 7),
+                                        ('Q', 7, 'K', 'R', 0),
+                                        ('k', 0, 'k', 'r', 7),
+                                        ('q', 0, 'k', 'r', 0)):
+            if right in castling and rows[y][4] == king and rows[y][x] == rook:
+                rights += right
+        castling = rights
+        # the pawn that can be taken en passant has just moved, so the
+        # square behind it is on the other player's side of the board
+        if fields[1] == 'w':
+            ep_rank = '6'
+        else:
+            ep_rank = '3'
+        if ep != '-' and (len(ep) != 2 or ep[0] not in "abcdefgh" or
+                          ep[1] != ep_rank):
+            raise ValueError("invalid FEN: '%s'" % fen)
+        try:
+            stasis = int(fields[4]) if len(fields) > 4 else 0
+            number = int(fields[5]) if len(fields) > 5 else 1
+        except ValueError:
+            raise ValueError("invalid FEN: '%s'" % fen)
+        self.setBoard(rows)
+        state.player = fields[1]
+        state.white_king_castle = 'K' in castling
+        state.white_queen_castle = 'Q' in castling
+        state.black_king_castle = 'k' in castling
+        state.black_queen_castle = 'q' in castling
+        if ep == '-':
+            state.clearEP()
+        elif ep[1] == '3':
+            # FEN names the square behind the pawn, State the pawn itself
+            state.setEP(("abcdefgh".index(ep[0]), 4))
+        else:
+            state.setEP(("abcdefgh".index(ep[0]), 3))
+        state.stasis_count = stasis
+        state.move_count = (max(number, 1) - 1) * 2
+        if state.player == 'b':
+            state.move_count += 1
+        state.game_result = 0
+        state.reason = 0
+        state.push_stack = []
+        state.push_keys = []
+        state.zobrist = zobristKey(self.board)
+        state.setKingLocations(self.board)
+        state.clearHistory()
+
+    def getFEN(self, state):
+        """
+        Returns the position as a FEN string.
+        """
+        ranks = []
+        for row in self.board:
+            rank = ""
+            empty = 0
+            for p in row:
+                if p == ' ':
+                    empty += 1
+                    continue
+                if empty:
+                    rank += "%d" % empty
+                    empty = 0
+                rank += p
+            if empty:
+                rank += "%d" % empty
+            ranks.append(rank)
+        castling = ""
+        if state.white_king_castle:
+            castling += "K"
+        if state.white_queen_castle:
+            castling += "Q"
+        if state.black_king_castle:
+            castling += "k"
+        if state.black_queen_castle:
+            castling += "q"
+        if state.ep[1] == 4:
+            ep = "%s3" % "abcdefgh"[state.ep[0]]
+        elif state.ep[1] == 3:
+            ep = "%s6" % "abcdefgh"[state.ep[0]]
+        else:
+            ep = "-"
+        return "%s %s %s %s %d %d" % ("/".join(ranks), state.player,
+                                      castling or "-", ep,
+                                      state.stasis_count,
+                                      state.move_count // 2 + 1)
+
+    def setEvalTable(self, table):
+        """
+        Makes squareChanged keep eval_score, the sum of the values in
+        table (see getEvalTable) of the pieces on their squares, or
+        stop doing so if table is None.
+        """
+        self.eval_table = table
+        self.eval_score = 0
+        if table is not None:
+            for y in range(8):
+                for x in range(8):
+                    self.eval_score += table[self.board[y][x]][y * 8 + x]
+
+    def getThreatened(self, state, color):
+        """
+        Returns the locations of the pieces of color that the other
+        player attacks.
+        """
+        player = state.player
+        state.player = color
+        threatened = [(x, y) for x, y in self.getPieces(color)
+                      if self.isThreatened(state, x, y)]
+        state.player = player
+        return threatened
+
+    def getBitboards(self):
+        """
+        Returns (bitboards, occupied): a bitboard of the squares of
+        each piece character, and of all pieces. Bit y * 8 + x is
+        square (x, y).
+        """
+        bbs = dict((p, 0) for p in "PNBRQKpnbrqk")
+        occupied = 0
+        for color in ('w', 'b'):
+            for sq in self.pieces[color]:
+                bbs[self.board[sq // 8][sq % 8]] |= 1 << sq
+                occupied |= 1 << sq
+        return bbs, occupied
+
+    def staticExchange(self, state, fromPos, toPos):
+        """
+        Returns the static exchange evaluation of moving the piece on
+        fromPos to toPos, in pawns (see EXCHANGE_VALUES): the material
+        its side wins if both sides go on capturing on toPos with
+        their least valuable piece, each side free to stop when that
+        pays. Pins are not looked at; x-ray attackers behind the
+        pieces that capture are.
+        """
+        bbs, occupied = self.getBitboards()
+        values = self.EXCHANGE_VALUES
+        fx, fy = fromPos
+        tx, ty = toPos
+        sq = ty * 8 + tx
+        piece = self.board[fy][fx]
+        victim = self.board[ty][tx]
+        if victim != ' ':
+            gain = [values[victim.upper()]]
+        elif piece.upper() == 'P' and tx != fx:
+            # en passant; the captured pawn leaves its square too
+            gain = [values['P']]
+            occupied &= ~(1 << (fy * 8 + tx))
+        else:
+            gain = [0]
+        on_square = values[piece.upper()]
+        if piece.upper() == 'P' and (ty == 0 or ty == 7):
+            gain[0] += values['Q'] - values['P']
+            on_square = values['Q']
+        occupied &= ~(1 << (fy * 8 + fx))
+        if piece.isupper():
+            side, other = 'b', 'w'
+        else:
+            side, other = 'w', 'b'
+        while True:
+            attackers = squareAttackers(bbs, sq, side, occupied) & occupied
+            if not attackers:
+                break
+            for p in "PNBRQK":
+                if side == 'b':
+                    p = p.lower()
+                if attackers & bbs[p]:
+                    b = attackers & bbs[p]
+                    b &= -b
+                    break
+            if p.upper() == 'K':
+                # the king may only take if nothing can take it back
+                if squareAttackers(bbs, sq, other, occupied) & occupied:
+                    break
+            gain.append(on_square - gain[-1])
+            on_square = values[p.upper()]
+            occupied ^= b
+            side, other = other, side
+        # each side takes only if that is better than standing pat
+        while len(gain) > 1:
+            last = gain.pop()
+            gain[-1] = -max(-gain[-1], last)
+        return gain[0]
+
+    def startTracking(self):
+        """
+        Empties the structures that squareChanged keeps: the squares
+        of each color's pieces, and of each king.
+        """
+        self.pieces = {'w': set(), 'b': set()}
+        self.kings = {'w': None, 'b': None}
+
+    def squareChanged(self, x, y, old, new):
+        """
+        Called by the board rows whenever a square is written.
+        """
+        sq = y * 8 + x
+        if old != ' ':
+            if old.isupper():
+                color = 'w'
+            else:
+                color = 'b'
+            self.pieces[color].discard(sq)
+            if (old == 'K' or old == 'k') and self.kings[color] == (x, y):
+                self.kings[color] = None
+        if new != ' ':
+            if new.isupper():
+                color = 'w'
+            else:
+                color = 'b'
+            self.pieces[color].add(sq)
+            if new == 'K' or new == 'k':
+                self.kings[color] = (x, y)
+        if self.eval_table is not None:
+            self.eval_score += (self.eval_table[new][sq] -
+                                self.eval_table[old][sq])
+
+    def getPieces(self, color):
+        """
+        Returns the locations of the pieces of color ('w' or 'b'), in
+        board order.
+        """
+        return [(sq % 8, sq // 8) for sq in sorted(self.pieces[color])]
 
     def getKingLocation(self, state):
-        for y in range(0,8):
-            for x in range(0,8):
-                if self.board[y][x] == "K" and state.player == 'w':
-                    return (x,y)
-                if self.board[y][x] == "k" and state.player == 'b':
-                    return (x,y)
+        return self.kings[state.player]
 
     def isCheck(self, state):
         """
@@ -1070,7 +1872,7 @@ class ChessBoard(object):
         N=Night, R=Rook, P=Pawn.  Empty squares are markt with a
         period (.)
         """
-        return deepcopy(self.board)        
+        return [list(row) for row in self.board]
 
     def makeMove(self, state, fromPos, toPos):
         """
@@ -1084,8 +1886,27 @@ class ChessBoard(object):
         """        
         fx, fy = fromPos
         tx, ty = toPos
-        state.cur_move[1]=fromPos        
-        state.cur_move[2]=toPos
+        if not (0 <= fx <= 7 and 0 <= fy <= 7 and
+                0 <= tx <= 7 and 0 <= ty <= 7):
+            return self.applyMove(state, fromPos, toPos)
+        undo = self.makeUndo(state, fromPos, toPos)
+        hint = self.getDisambiguation(state, fromPos, toPos)
+        if not self.applyMove(state, fromPos, toPos):
+            return False
+        state.cur_move[7] = hint
+        state.pushState(self.board, undo)
+        state.move_count += 1
+        return True 
+
+    def applyMove(self, state, fromPos, toPos):
+        """
+        Checks and makes a move on the board and in the state, without
+        recording it in the state history. Returns True if that was a
+        valid move.
+        """
+        fx, fy = fromPos
+        tx, ty = toPos
+        state.cur_move = [None, fromPos, toPos, False, None, None, 0, 0]
         #check invalid coordinates
         if fx < 0 or fx > 7 or fy < 0 or fy > 7:
             state.reason = self.INVALID_FROM_LOCATION
@@ -1136,11 +1957,103 @@ class ChessBoard(object):
                 return False
         else:
             return False
-        state.pushState(self.board)
-        state.pushMove()
-        other = self.getOtherPlayerState(state)
+        # a rook taken on its starting square can no longer castle:
+        if (tx, ty) == (7, 0):
+            state.black_king_castle = False
+        elif (tx, ty) == (0, 0):
+            state.black_queen_castle = False
+        elif (tx, ty) == (7, 7):
+            state.white_king_castle = False
+        elif (tx, ty) == (0, 7):
+            state.white_queen_castle = False
+        return True
+
+    def push(self, state, move):
+        """
+        Makes move, a (fromPos, toPos) or (fromPos, toPos, promotion)
+        tuple, in place and hands the turn to the other player. The
+        state history is left alone; instead a small undo record is
+        kept so that pop() can take the move back. Returns True if
+        that was a valid move.
+        """
+        fromPos, toPos = move[0], move[1]
+        undo = self.makeUndo(state, fromPos, toPos)
+        if len(move) > 2:
+            state.promotion_value = move[2]
+        if not self.applyMove(state, fromPos, toPos):
+            self.restore(state, undo)
+            return False
+        state.player = self.getOtherPlayer(state)
         state.move_count += 1
-        return True 
+        state.push_stack.append(undo)
+        state.push_keys.append(state.getKey())
+        return True
+
+    def makeUndo(self, state, fromPos, toPos):
+        """
+        Returns the undo record for restore() of the move from fromPos
+        to toPos, taken before it is made.
+        """
+        fx, fy = fromPos
+        tx, ty = toPos
+        return (fromPos, toPos, self.board[fy][fx], self.board[ty][tx],
+                self.board[fy][tx],
+                (state.white_king_castle, state.white_queen_castle,
+                 state.black_king_castle, state.black_queen_castle),
+                (state.ep[0], state.ep[1]), state.stasis_count,
+                state.player, state.game_result, state.reason,
+                state.cur_move, state.promotion_value, state.move_count,
+                state.zobrist)
+
+    def pop(self, state):
+        """
+        Takes back the last move made with push(). Returns False if
+        there is nothing to take back.
+        """
+        if not state.push_stack:
+            return False
+        self.restore(state, state.push_stack.pop())
+        state.push_keys.pop()
+        return True
+
+    def restore(self, state, undo):
+        """
+        Puts the board and state back the way they were before the
+        move described by the undo record.
+        """
+        (fromPos, toPos, piece, captured, beside, castling, ep, stasis,
+         player, game_result, reason, cur_move, promotion,
+         move_count, zobrist) = undo
+        fx, fy = fromPos
+        tx, ty = toPos
+        board = self.board
+        board[fy][fx] = piece
+        board[ty][tx] = captured
+        if piece in 'Pp':
+            # en passant capture
+            board[fy][tx] = beside
+        if piece == 'K':
+            state.white_king_location = tuple(fromPos)
+        elif piece == 'k':
+            state.black_king_location = tuple(fromPos)
+        if piece in 'Kk' and abs(tx - fx) == 2:
+            if tx == 6:
+                board[fy][5] = ' '
+                board[fy][7] = 'R' if piece == 'K' else 'r'
+            else:
+                board[fy][3] = ' '
+                board[fy][0] = 'R' if piece == 'K' else 'r'
+        (state.white_king_castle, state.white_queen_castle,
+         state.black_king_castle, state.black_queen_castle) = castling
+        state.ep[0], state.ep[1] = ep
+        state.stasis_count = stasis
+        state.player = player
+        state.game_result = game_result
+        state.reason = reason
+        state.cur_move = cur_move
+        state.promotion_value = promotion
+        state.move_count = move_count
+        state.zobrist = zobrist
 
     def getOtherPlayerState(self, state):
         newState = deepcopy(state)
@@ -1150,14 +2063,14 @@ class ChessBoard(object):
             newState.player = 'w'
         return newState
 
-    def checkStatus(self, state):
+    def checkStatus(self, state, verbose=True):
         #print("Move: %s" % state.move_count)
         #print(self)
         if self.isCheck(state):
-            state.cur_move[5]="+"
+            state.setCheck("+")
         if not self.hasAnyValidMoves(state):
             if self.isCheck(state):
-                state.cur_move[5]="#"
+                state.setCheck("#")
                 if state.player == 'w':
                     state.endGame(self.BLACK_WIN)
                 else:            
@@ -1169,32 +2082,503 @@ class ChessBoard(object):
                 state.endGame(self.STASIS_COUNT_LIMIT_RULE)
             elif state.threeRepetitions():
                 state.endGame(self.THREE_REPETITION_RULE)
-        printReason(state.game_result)
+        if verbose:
+            printReason(state.game_result)
 
-def makeWindow(size):
-    window = Graphics.Window("Chess", size, size)
-    for x in range(8):
-        for y in range(8):
-            r = Graphics.Rectangle((x * size/8, y * size/8),
-                                   ((x + 1) * size/8, (y + 1) * size/8))
-            if ((x % 2 == 0 and y % 2 == 0) or
-                (x % 2 == 1 and y % 2 == 1)):
-                r.color = Graphics.Color("white")
-            else:
-                r.color = Graphics.Color("gray")
-            r.draw(window)
-    for x in range(8):
-        line = Graphics.Line((x * size/8, 0), (x * size/8, size))
-        line.draw(window)
-    for y in range(8):
-        line = Graphics.Line((0, y * size/8), (size, y * size/8))
-        line.draw(window)
-    images = {}
-    for x,w,piece in ((0,70,"king"), (140,80,"queen"), (300,60,"rook"),
-                      (440,514-440,"bishop"), (590,662-590,"knight"), (750,50,"pawn")):
-        for y,color in ((0, "black"), (125, "white")):
-            images[(piece, color)] = (x, y, w, 80)
-    return window, images
+#-----------------------------------------------------------------------
+# Bitboards
+#
+# A bitboard is an int where bit (y * 8 + x) stands for square (x, y),
+# so bit 0 is (0, 0) (a8) and bit 63 is (7, 7) (h1).
+#-----------------------------------------------------------------------
+
+ROOK_DIRS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+BISHOP_DIRS = [(1, 1), (-1, 1), (1, -1), (-1, -1)]
+QUEEN_DIRS = ROOK_DIRS + BISHOP_DIRS
+
+def makeStepTable(offsets):
+    """
+    For each square, the bitboard of squares reached by one of the
+    (dx, dy) offsets without leaving the board.
+    """
+    table = []
+    for sq in range(64):
+        x, y = sq % 8, sq // 8
+        bb = 0
+        for dx, dy in offsets:
+            if 0 <= x + dx <= 7 and 0 <= y + dy <= 7:
+                bb |= 1 << ((y + dy) * 8 + x + dx)
+        table.append(bb)
+    return table
+
+def makeRayTable(d):
+    """
+    For each square, the bitboard of squares on the ray in direction
+    d, not including the square itself.
+    """
+    dx, dy = d
+    table = []
+    for sq in range(64):
+        x, y = sq % 8 + dx, sq // 8 + dy
+        bb = 0
+        while 0 <= x <= 7 and 0 <= y <= 7:
+            bb |= 1 << (y * 8 + x)
+            x += dx
+            y += dy
+        table.append(bb)
+    return table
+
+KNIGHT_ATTACKS = makeStepTable([(1, 2), (2, 1), (2, -1), (1, -2),
+                                (-1, 2), (-2, 1), (-1, -2), (-2, -1)])
+KING_ATTACKS = makeStepTable(QUEEN_DIRS)
+# Squares attacked by a pawn of the given color standing on a square:
+PAWN_ATTACKS = {'w': makeStepTable([(1, -1), (-1, -1)]),
+                'b': makeStepTable([(1, 1), (-1, 1)])}
+RAYS = dict((d, makeRayTable(d)) for d in QUEEN_DIRS)
+STEPS = dict((d, makeStepTable([d])) for d in QUEEN_DIRS)
+# Rays running towards higher square numbers stop at their lowest set
+# blocker, the others at their highest:
+POSITIVE_DIRS = dict((d, d[1] * 8 + d[0] > 0) for d in QUEEN_DIRS)
+
+def rayAttacks(d, sq, occupied):
+    """
+    Squares attacked from sq along direction d, up to and including
+    the first occupied square.
+    """
+    ray = RAYS[d][sq]
+    blockers = ray & occupied
+    if blockers:
+        if POSITIVE_DIRS[d]:
+            first = (blockers & -blockers).bit_length() - 1
+        else:
+            first = blockers.bit_length() - 1
+        ray ^= RAYS[d][first]
+    return ray
+
+def slidingAttacks(dirs, sq, occupied):
+    bb = 0
+    for d in dirs:
+        bb |= rayAttacks(d, sq, occupied)
+    return bb
+
+ALL_SQUARES = (1 << 64) - 1
+
+def between(a, b):
+    """
+    The squares strictly between squares a and b, and b itself, if
+    they are on a line; just b otherwise.
+    """
+    ax, ay = a % 8, a // 8
+    bx, by = b % 8, b // 8
+    dx, dy = bx - ax, by - ay
+    if dx and dy and abs(dx) != abs(dy):
+        return 1 << b
+    d = ((dx > 0) - (dx < 0), (dy > 0) - (dy < 0))
+    return RAYS[d][a] ^ RAYS[d][b]
+
+def bitSquares(bb):
+    """
+    Returns the (x, y) locations of the set bits, lowest first.
+    """
+    squares = []
+    while bb:
+        b = bb & -bb
+        sq = b.bit_length() - 1
+        squares.append((sq % 8, sq // 8))
+        bb ^= b
+    return squares
+
+def squareAttackers(bbs, sq, color, occupied):
+    """
+    The bitboard of pieces of color in bbs, a bitboard per piece
+    character, that attack sq when the occupied squares are occupied.
+    Sliders are seen through squares missing from occupied, but the
+    pieces themselves are not masked with it.
+    """
+    if color == 'w':
+        p, n, b, r, q, k = 'P', 'N', 'B', 'R', 'Q', 'K'
+        defender = 'b'
+    else:
+        p, n, b, r, q, k = 'p', 'n', 'b', 'r', 'q', 'k'
+        defender = 'w'
+    return ((PAWN_ATTACKS[defender][sq] & bbs[p]) |
+            (KNIGHT_ATTACKS[sq] & bbs[n]) |
+            (KING_ATTACKS[sq] & bbs[k]) |
+            (slidingAttacks(ROOK_DIRS, sq, occupied) &
+             (bbs[r] | bbs[q])) |
+            (slidingAttacks(BISHOP_DIRS, sq, occupied) &
+             (bbs[b] | bbs[q])))
+
+class BitBoard(ChessBoard):
+    """
+    A ChessBoard that also keeps the position as one bitboard per
+    piece, and per color, and answers attack and move queries from
+    the precomputed tables above. The board attribute is still there,
+    and writes to it keep the bitboards up to date.
+
+    It also keeps the squares attacked by the piece on each square,
+    updating only the pieces a write affects, so that isThreatened is
+    a lookup in the attack map of the other color.
+    """
+    def startTracking(self):
+        self.bitboards = dict((p, 0) for p in "PNBRQKpnbrqk")
+        self.colors = {'w': 0, 'b': 0}
+        self.occupied = 0
+        self.attacks_from = [0] * 64
+        self.attack_maps = {'w': 0, 'b': 0}
+        self.attacks_dirty = False
+
+    def squareChanged(self, x, y, old, new):
+        bit = 1 << (y * 8 + x)
+        if old != ' ':
+            self.bitboards[old] ^= bit
+            if old.isupper():
+                self.colors['w'] ^= bit
+            else:
+                self.colors['b'] ^= bit
+        if new != ' ':
+            self.bitboards[new] ^= bit
+            if new.isupper():
+                self.colors['w'] ^= bit
+            else:
+                self.colors['b'] ^= bit
+        self.occupied = self.colors['w'] | self.colors['b']
+        sq = y * 8 + x
+        if new == ' ':
+            self.attacks_from[sq] = 0
+        else:
+            self.attacks_from[sq] = self.pieceAttacks(new, sq)
+        if (old == ' ') != (new == ' '):
+            # sliders that reach this square now see more or less
+            # of the board behind it:
+            bbs = self.bitboards
+            sliders = ((slidingAttacks(ROOK_DIRS, sq, self.occupied) &
+                        (bbs['R'] | bbs['r'] | bbs['Q'] | bbs['q'])) |
+                       (slidingAttacks(BISHOP_DIRS, sq, self.occupied) &
+                        (bbs['B'] | bbs['b'] | bbs['Q'] | bbs['q'])))
+            while sliders:
+                b = sliders & -sliders
+                s = b.bit_length() - 1
+                self.attacks_from[s] = self.pieceAttacks(
+                    self.board[s // 8][s % 8], s)
+                sliders ^= b
+        self.attacks_dirty = True
+        if self.eval_table is not None:
+            self.eval_score += (self.eval_table[new][sq] -
+                                self.eval_table[old][sq])
+
+    def pieceAttacks(self, p, sq):
+        """
+        The squares that piece p standing on sq attacks.
+        """
+        u = p.upper()
+        if u == 'P':
+            if p == 'P':
+                return PAWN_ATTACKS['w'][sq]
+            return PAWN_ATTACKS['b'][sq]
+        elif u == 'N':
+            return KNIGHT_ATTACKS[sq]
+        elif u == 'K':
+            return KING_ATTACKS[sq]
+        elif u == 'R':
+            return slidingAttacks(ROOK_DIRS, sq, self.occupied)
+        elif u == 'B':
+            return slidingAttacks(BISHOP_DIRS, sq, self.occupied)
+        return slidingAttacks(QUEEN_DIRS, sq, self.occupied)
+
+    def getAttackMap(self, color):
+        """
+        The bitboard of squares attacked by the pieces of color.
+        """
+        if self.attacks_dirty:
+            for c in ('w', 'b'):
+                attacks = 0
+                pieces = self.colors[c]
+                while pieces:
+                    b = pieces & -pieces
+                    attacks |= self.attacks_from[b.bit_length() - 1]
+                    pieces ^= b
+                self.attack_maps[c] = attacks
+            self.attacks_dirty = False
+        return self.attack_maps[color]
+
+    def getBitboards(self):
+        return self.bitboards, self.occupied
+
+    def attackersTo(self, sq, color, occupied=None):
+        """
+        The bitboard of pieces of color attacking sq, found by looking
+        out from sq. occupied defaults to the current occupancy.
+        """
+        if occupied is None:
+            occupied = self.occupied
+        return squareAttackers(self.bitboards, sq, color, occupied)
+
+    def checkKingGuard(self, state, fromPos, moves, specialMoves={}):
+        # Same test as ChessBoard.checkKingGuard, but with the move
+        # made on a copy of the occupancy instead of on the board.
+        kx, ky = self.getKingLocation(state)
+        ksq = ky * 8 + kx
+        other = self.getOtherPlayer(state)
+        occupied = self.occupied ^ (1 << (fromPos[1] * 8 + fromPos[0]))
+        if (not self.attackersTo(ksq, other, occupied) and
+            self.EP_CAPTURE_MOVE not in specialMoves.values()):
+            return moves
+        result = []
+        for m in moves:
+            captured = 1 << (m[1] * 8 + m[0])
+            occ = occupied | captured
+            if ((m in specialMoves) and
+                specialMoves[m] == self.EP_CAPTURE_MOVE):
+                victim = 1 << (state.ep[1] * 8 + state.ep[0])
+                occ ^= victim
+                captured |= victim
+            if not self.attackersTo(ksq, other, occ) & ~captured:
+                result.append(m)
+        return result
+
+    def isThreatened(self, state, lx, ly):
+        if state.player == 'w':
+            attacks = self.getAttackMap('b')
+        else:
+            attacks = self.getAttackMap('w')
+        return (attacks >> (ly * 8 + lx)) & 1 == 1
+
+    def traceValidMoves(self, state, fromPos, dirs, maxSteps=8):
+        sq = fromPos[1] * 8 + fromPos[0]
+        targets = 0
+        if maxSteps == 1:
+            for d in dirs:
+                targets |= STEPS[d][sq]
+        elif maxSteps >= 7:
+            targets = slidingAttacks(dirs, sq, self.occupied)
+        else:
+            return ChessBoard.traceValidMoves(self, state, fromPos, dirs,
+                                              maxSteps)
+        return bitSquares(targets & ~self.colors[state.player])
+
+    def getValidKnightMoves(self, state, fromPos):
+        sq = fromPos[1] * 8 + fromPos[0]
+        moves = bitSquares(KNIGHT_ATTACKS[sq] & ~self.colors[state.player])
+        return self.checkKingGuard(state, fromPos, moves)
+
+    def hasAnyValidMoves(self, state):
+        if state.game_result:
+            return False
+        cache = self.getMoveCache(state)
+        if self.move_list is not None:
+            return len(self.move_list) > 0
+        for location, p, moves in self.generateMoves(state, cache, True):
+            if moves:
+                return True
+        return False
+
+    def getMoves(self, state):
+        cache = self.getMoveCache(state)
+        if self.move_list is None:
+            self.move_list = [move for move in
+                              self.generateMoves(state, cache, False)
+                              if move[2]]
+        return self.copyMoves(self.move_list)
+
+    def generateMoves(self, state, cache, cheapFirst):
+        """
+        Generates (location, piece, moves) for every piece of the
+        player, legal moves only: the pieces giving check and the
+        pinned pieces are worked out once, and then each piece's
+        targets are limited to what answers the check and stays on its
+        pin line. Pieces come in board order, or with cheapFirst, the
+        king first and pinned pieces last. Moves found are added to
+        cache, and moves already in it are used as they are.
+        """
+        us = state.player
+        them = self.getOtherPlayer(state)
+        if us == 'w':
+            king = self.bitboards['K']
+        else:
+            king = self.bitboards['k']
+        if not king:
+            for move in ChessBoard.getMoves(self, state):
+                yield move
+            return
+        ksq = king.bit_length() - 1
+        own = self.colors[us]
+        checkers = self.attackersTo(ksq, them)
+        if not checkers:
+            evasions = ALL_SQUARES
+        elif checkers & (checkers - 1):
+            # double check, only the king can move
+            evasions = 0
+        else:
+            # take the checker or block it
+            evasions = checkers | between(ksq, checkers.bit_length() - 1)
+        pins = self.getPins(ksq, us, them)
+        if cheapFirst:
+            pinned = 0
+            for sq in pins:
+                pinned |= 1 << sq
+            order = [king, own & ~king & ~pinned, pinned]
+        else:
+            order = [own]
+        for pieces in order:
+            while pieces:
+                b = pieces & -pieces
+                pieces ^= b
+                sq = b.bit_length() - 1
+                x, y = sq % 8, sq // 8
+                p = self.board[y][x]
+                if (x, y) in cache:
+                    yield (x, y), p, cache[(x, y)]
+                    continue
+                if p == 'K' or p == 'k':
+                    targets = self.getKingTargets(state, sq, them)
+                elif p == 'P' or p == 'p':
+                    targets = self.getPawnTargets(state, sq, evasions,
+                                                  pins.get(sq, ALL_SQUARES),
+                                                  ksq, them)
+                else:
+                    targets = self.attacks_from[sq] & ~own & evasions
+                    if sq in pins:
+                        targets &= pins[sq]
+                moves = bitSquares(targets)
+                cache[(x, y)] = moves
+                yield (x, y), p, moves
+
+    def getPins(self, ksq, us, them):
+        """
+        Returns a dictionary from the square of each piece of us that
+        is pinned to its king to the line it may still move along.
+        """
+        pins = {}
+        bbs = self.bitboards
+        if them == 'w':
+            straight = bbs['R'] | bbs['Q']
+            diagonal = bbs['B'] | bbs['Q']
+        else:
+            straight = bbs['r'] | bbs['q']
+            diagonal = bbs['b'] | bbs['q']
+        for d in QUEEN_DIRS:
+            if d[0] == 0 or d[1] == 0:
+                sliders = straight
+            else:
+                sliders = diagonal
+            if not RAYS[d][ksq] & sliders:
+                continue
+            ray = rayAttacks(d, ksq, self.occupied)
+            first = ray & self.occupied & self.colors[us]
+            if not first:
+                continue
+            fsq = first.bit_length() - 1
+            beyond = rayAttacks(d, fsq, self.occupied)
+            if beyond & self.occupied & sliders:
+                pins[fsq] = ray | beyond
+        return pins
+
+    def getPawnTargets(self, state, sq, evasions, pin, ksq, them):
+        x, y = sq % 8, sq // 8
+        if state.player == 'w':
+            step = -8
+            startrow = 6
+            eprow = 3
+        else:
+            step = 8
+            startrow = 1
+            eprow = 4
+        occupied = self.occupied
+        targets = 0
+        ahead = sq + step
+        if not (occupied >> ahead) & 1:
+            targets |= 1 << ahead
+            if y == startrow and not (occupied >> (ahead + step)) & 1:
+                targets |= 1 << (ahead + step)
+        targets |= self.attacks_from[sq] & self.colors[them]
+        targets &= evasions & pin
+        if y == eprow and state.ep[1] != 0 and abs(state.ep[0] - x) == 1:
+            # Rather than work out all the ways an en passant capture
+            # can answer a check or uncover one, try it out:
+            to = ahead - x + state.ep[0]
+            victim = 1 << (y * 8 + state.ep[0])
+            occ = (occupied ^ (1 << sq) ^ victim) | (1 << to)
+            if not self.attackersTo(ksq, them, occ) & ~victim:
+                targets |= 1 << to
+        return targets
+
+    def getKingTargets(self, state, sq, them):
+        occupied = self.occupied ^ (1 << sq)
+        targets = 0
+        candidates = KING_ATTACKS[sq] & ~self.colors[state.player]
+        while candidates:
+            b = candidates & -candidates
+            candidates ^= b
+            if not self.attackersTo(b.bit_length() - 1, them, occupied):
+                targets |= b
+        if state.player == 'w':
+            row = 7
+            c_king = state.white_king_castle
+            c_queen = state.white_queen_castle
+            r = 'R'
+        else:
+            row = 0
+            c_king = state.black_king_castle
+            c_queen = state.black_queen_castle
+            r = 'r'
+        if c_king or c_queen:
+            board = self.board[row]
+            attacked = self.getAttackMap(them) >> (row * 8)
+            if (c_king and board[5] == ' ' and board[6] == ' ' and
+                board[7] == r and not attacked & 0x70):
+                targets |= 1 << (row * 8 + 6)
+            if (c_queen and board[3] == ' ' and board[2] == ' ' and
+                board[1] == ' ' and board[0] == r and not attacked & 0x1c):
+                targets |= 1 << (row * 8 + 2)
+        return targets
+
+    def getPieces(self, color):
+        return bitSquares(self.colors[color])
+
+    def getThreatened(self, state, color):
+        if color == 'w':
+            return bitSquares(self.colors['w'] & self.getAttackMap('b'))
+        return bitSquares(self.colors['b'] & self.getAttackMap('w'))
+
+    def getKingLocation(self, state):
+        if state.player == 'w':
+            k = self.bitboards['K']
+        else:
+            k = self.bitboards['k']
+        if k:
+            sq = k.bit_length() - 1
+            return (sq % 8, sq // 8)
+
+BACKENDS = {"list": ChessBoard,
+            "bitboard": BitBoard}
+
+INITIAL_ZOBRIST = zobristKey(ChessBoard().board)
+
+def makeWindow(size):
+    window = Graphics.Window("Chess", size, size)
+    for x in range(8):
+        for y in range(8):
+            r = Graphics.Rectangle((x * size/8, y * size/8),
+                                   ((x + 1) * size/8, (y + 1) * size/8))
+            if ((x % 2 == 0 and y % 2 == 0) or
+                (x % 2 == 1 and y % 2 == 1)):
+                r.color = Graphics.Color("white")
+            else:
+                r.color = Graphics.Color("gray")
+            r.draw(window)
+    for x in range(8):
+        line = Graphics.Line((x * size/8, 0), (x * size/8, size))
+        line.draw(window)
+    for y in range(8):
+        line = Graphics.Line((0, y * size/8), (size, y * size/8))
+        line.draw(window)
+    images = {}
+    for x,w,piece in ((0,70,"king"), (140,80,"queen"), (300,60,"rook"),
+                      (440,514-440,"bishop"), (590,662-590,"knight"), (750,50,"pawn")):
+        for y,color in ((0, "black"), (125, "white")):
+            images[(piece, color)] = (x, y, w, 80)
+    return window, images
 
 #chess_set = Graphics.Picture(calico.relativePath("../examples/images/chess_set.png"))
 
@@ -1232,11 +2616,11 @@ def displayBoard(window, board, images, count):
     else:
         window.removeTagged("piece-even")
 
-def gplay(player1, player2):
+def gplay(player1, player2, backend=None):
     # player1 is black
     # player2 is white
     state = State('w')
-    board = ChessBoard()
+    board = ChessBoard(backend)
     size = 600
     window, images = makeWindow(size)
     window.title = "Chess: %s (black) vs %s (white)" % (player1.__name__, player2.__name__)
@@ -1281,11 +2665,11 @@ def gplay(player1, player2):
             break
     return state.game_result
 
-def play(player1, player2):
+def play(player1, player2, backend=None):
     # player1 is black
     # player2 is white
     state = State('w')
-    board = ChessBoard()
+    board = ChessBoard(backend)
     print(board)
     while state.game_result == 0:
         moves = board.getMoves(state)
@@ -1307,6 +2691,52 @@ def play(player1, player2):
             break
     return state.game_result
 
+class GameResult(object):
+    """
+    How a game played by playQuiet went: result is the game_result
+    code (0 if the ply limit stopped it), moves the (fromPos, toPos)
+    of every ply, and board, player and position (as made by
+    makeRepr) the final position.
+    """
+    def __init__(self, result, moves, board, state):
+        self.result = result
+        self.reason = REASON_NAMES.get(result, str(result))
+        self.plies = len(moves)
+        self.moves = moves
+        self.board = board.getBoard()
+        self.player = state.player
+        self.position = makeRepr(state, board.board)
+
+    def __repr__(self):
+        return "<GameResult %s after %d plies>" % (self.reason, self.plies)
+
+def playQuiet(player1, player2, max_plies=None, backend=None):
+    """
+    Plays a game like play(), but without printing anything, and
+    stops after max_plies halfmoves if given. Returns a GameResult.
+    """
+    # player1 is black
+    # player2 is white
+    state = State('w')
+    board = ChessBoard(backend)
+    made = []
+    while state.game_result == 0:
+        if max_plies is not None and len(made) >= max_plies:
+            break
+        moves = board.getMoves(state)
+        if not moves:
+            break
+        if state.player == 'w':
+            fromPos, toPos = player2(board, state, moves)
+        else:
+            fromPos, toPos = player1(board, state, moves)
+        board.makeMove(state, fromPos, toPos)
+        made.append((fromPos, toPos))
+        if state.game_result == 0:
+            state.player = board.getOtherPlayer(state)
+            board.checkStatus(state, verbose=False)
+    return GameResult(state.game_result, made, board, state)
+
 def randomPlayer1(board, state, moves):
     """
     This is a bad random player... first it picks a
@@ -1355,11 +2785,11 @@ def player1(board, state, moves):
     # and see what the results are:
     for move in tofrom:
         fromPos, toPos, score = move
-        newboard = deepcopy(board)
-        newstate = deepcopy(state)
-        newboard.makeMove(newstate, fromPos, toPos)
-        # go through board and return a score
-        move[2] = staticAnalysis(newboard, newstate)
+        board.push(state, (fromPos, toPos))
+        # go through board and return a score; push has
+        # handed the turn over, so score it for the other side:
+        move[2] = -staticAnalysis(board, state)
+        board.pop(state)
     tofrom.sort(key=lambda move: move[2]) # sort on score
     # return the highest from, to:
     return tofrom[-1][0], tofrom[-1][1]
@@ -1378,28 +2808,25 @@ def evaluateColor(board, state, player):
     state.player = player
     #print("evaluateColor", state.player)
     total = random.random() # small random value
-    for x in range(8):
-        for y in range(8):
-            color = board.getColor(x, y)
-            piece = board.board[y][x].upper()
-            if color == state.player:
-                score = 0
-                if piece == 'K':
-                    score += 1000
-                elif piece == 'Q':
-                    score += 216
-                elif piece == 'N':
-                    score += 108
-                elif piece == 'R':
-                    score += 56
-                elif piece == 'B':
-                    score += 28
-                elif piece == 'P':
-                    score += 14 * distanceToBackRow(player, y)
-                if board.isThreatened(state, x, y):
-                    #print("%s at (%s,%s) is threatend" % (piece, x, y))
-                    score *= .25
-                total += score
+    for x, y in board.getPieces(player):
+        piece = board.board[y][x].upper()
+        score = 0
+        if piece == 'K':
+            score += 1000
+        elif piece == 'Q':
+            score += 216
+        elif piece == 'N':
+            score += 108
+        elif piece == 'R':
+            score += 56
+        elif piece == 'B':
+            score += 28
+        elif piece == 'P':
+            score += 14 * distanceToBackRow(player, y)
+        if board.isThreatened(state, x, y):
+            #print("%s at (%s,%s) is threatend" % (piece, x, y))
+            score *= .25
+        total += score
     #if state.player == 'w':
     #    print(board)
     #    print(total)
@@ -1412,6 +2839,1521 @@ def distanceToBackRow(player, y):
     else:
         return y/7
 
+# Piece-square bonuses for the "pst" profile, for white with a8 first
+# (black uses the mirror image); from the "simplified evaluation
+# function" tables.
+PST_BONUS = {
+    'P': [  0,   0,   0,   0,   0,   0,   0,   0,
+           50,  50,  50,  50,  50,  50,  50,  50,
+           10,  10,  20,  30,  30,  20,  10,  10,
+            5,   5,  10,  25,  25,  10,   5,   5,
+            0,   0,   0,  20,  20,   0,   0,   0,
+            5,  -5, -10,   0,   0, -10,  -5,   5,
+            5,  10,  10, -20, -20,  10,  10,   5,
+            0,   0,   0,   0,   0,   0,   0,   0],
+    'N': [-50, -40, -30, -30, -30, -30, -40, -50,
+          -40, -20,   0,   0,   0,   0, -20, -40,
+          -30,   0,  10,  15,  15,  10,   0, -30,
+          -30,   5,  15,  20,  20,  15,   5, -30,
+          -30,   0,  15,  20,  20,  15,   0, -30,
+          -30,   5,  10,  15,  15,  10,   5, -30,
+          -40, -20,   0,   5,   5,   0, -20, -40,
+          -50, -40, -30, -30, -30, -30, -40, -50],
+    'B': [-20, -10, -10, -10, -10, -10, -10, -20,
+          -10,   0,   0,   0,   0,   0,   0, -10,
+          -10,   0,   5,  10,  10,   5,   0, -10,
+          -10,   5,   5,  10,  10,   5,   5, -10,
+          -10,   0,  10,  10,  10,  10,   0, -10,
+          -10,  10,  10,  10,  10,  10,  10, -10,
+          -10,   5,   0,   0,   0,   0,   5, -10,
+          -20, -10, -10, -10, -10, -10, -10, -20],
+    'R': [  0,   0,   0,   0,   0,   0,   0,   0,
+            5,  10,  10,  10,  10,  10,  10,   5,
+           -5,   0,   0,   0,   0,   0,   0,  -5,
+           -5,   0,   0,   0,   0,   0,   0,  -5,
+           -5,   0,   0,   0,   0,   0,   0,  -5,
+           -5,   0,   0,   0,   0,   0,   0,  -5,
+           -5,   0,   0,   0,   0,   0,   0,  -5,
+            0,   0,   0,   5,   5,   0,   0,   0],
+    'Q': [-20, -10, -10,  -5,  -5, -10, -10, -20,
+          -10,   0,   0,   0,   0,   0,   0, -10,
+          -10,   0,   5,   5,   5,   5,   0, -10,
+           -5,   0,   5,   5,   5,   5,   0,  -5,
+            0,   0,   5,   5,   5,   5,   0,  -5,
+          -10,   5,   5,   5,   5,   5,   0, -10,
+          -10,   0,   5,   0,   0,   0,   0, -10,
+          -20, -10, -10,  -5,  -5, -10, -10, -20],
+    'K': [-30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -20, -30, -30, -40, -40, -30, -30, -20,
+          -10, -20, -20, -20, -20, -20, -20, -10,
+           20,  20,   0,   0,   0,   0,  20,  20,
+           20,  30,  10,   0,   0,  10,  30,  20],
+    }
+
+# Value of each white piece on each square, by profile. "classic" has
+# the evaluateColor weights, "pst" centipawn material plus PST_BONUS.
+EVAL_PROFILES = {
+    "classic": {
+        'K': [1000] * 64,
+        'Q': [216] * 64,
+        'N': [108] * 64,
+        'R': [56] * 64,
+        'B': [28] * 64,
+        'P': [14 * distanceToBackRow('w', sq // 8) for sq in range(64)],
+        },
+    "pst": dict((p, [value + bonus for bonus in PST_BONUS[p]])
+                for p, value in [('P', 100), ('N', 320), ('B', 330),
+                                 ('R', 500), ('Q', 900), ('K', 20000)]),
+    }
+
+# Signed tables made by getEvalTable, by profile:
+eval_tables = {}
+
+def getEvalTable(profile):
+    """
+    Returns the table of profile that a ChessBoard keeps its score
+    with: for every piece character, and ' ', the value on each
+    square, positive for white and negative for black.
+    """
+    if profile not in eval_tables:
+        values = EVAL_PROFILES[profile]
+        table = {' ': [0] * 64}
+        for p in "PNBRQK":
+            table[p] = list(values[p])
+            table[p.lower()] = [-values[p][(7 - sq // 8) * 8 + sq % 8]
+                                for sq in range(64)]
+        eval_tables[profile] = table
+    return eval_tables[profile]
+
+class Evaluator(object):
+    """
+    An evaluation function to use in place of staticAnalysis, eg as
+    SearchPlayer(evaluate=Evaluator()): evaluator(board, state) scores
+    the position for state.player. The material and piece-square part
+    is kept by the board as pieces are moved (see
+    ChessBoard.setEvalTable), so it costs a lookup. profile picks the
+    values, from EVAL_PROFILES. The optional terms cost more:
+    threats is the part of its value a threatened piece loses, and
+    noise the size of a random term. Evaluator("classic", 0.75, 1.0)
+    scores like staticAnalysis.
+    """
+    def __init__(self, profile="classic", threats=0.0, noise=0.0):
+        if profile not in EVAL_PROFILES:
+            raise ValueError("unknown profile: '%s'" % profile)
+        self.profile = profile
+        self.threats = threats
+        self.noise = noise
+
+    def __call__(self, board, state):
+        table = getEvalTable(self.profile)
+        if board.eval_table is not table:
+            board.setEvalTable(table)
+        score = board.eval_score
+        if self.threats:
+            for color, sign in (('w', -1), ('b', 1)):
+                for x, y in board.getThreatened(state, color):
+                    score += (sign * self.threats *
+                              abs(table[board.board[y][x]][y * 8 + x]))
+        if self.noise:
+            score += self.noise * (random.random() - random.random())
+        if state.player == 'b':
+            return -score
+        return score
+
+#-----------------------------------------------------------------------
+# Batched evaluation
+#
+# Scores many positions at once with NumPy, which is optional: the
+# rest of the module works without it.
+#-----------------------------------------------------------------------
+
+# The piece of each plane in the arrays that packPositions makes:
+PLANE_PIECES = "PNBRQKpnbrqk"
+
+# Which of QUEEN_DIRS a knight, bishop, rook and queen slide along:
+BATCH_DIRECTIONS = [[0] * 8, [0] * 4 + [1] * 4, [1] * 4 + [0] * 4, [1] * 8]
+
+# NumPy index tables made by getBatchTables:
+batch_tables = {}
+
+def getBatchTables():
+    """
+    Returns the index tables for batchMobility: for each square, the
+    knight targets (64 x 8) and the squares along each of QUEEN_DIRS
+    going out from it (64 x 8 x 8), and BATCH_DIRECTIONS. Missing
+    squares are 64, which stands for a padding column; every ray ends
+    with at least one.
+    """
+    if not batch_tables:
+        knights = numpy.full((64, 8), 64, dtype=numpy.intp)
+        rays = numpy.full((64, 8, 8), 64, dtype=numpy.intp)
+        for sq in range(64):
+            for i, s in enumerate(bitSquares(KNIGHT_ATTACKS[sq])):
+                knights[sq, i] = s[1] * 8 + s[0]
+            for d, (dx, dy) in enumerate(QUEEN_DIRS):
+                x, y = sq % 8 + dx, sq // 8 + dy
+                i = 0
+                while 0 <= x <= 7 and 0 <= y <= 7:
+                    rays[sq, d, i] = y * 8 + x
+                    x, y = x + dx, y + dy
+                    i += 1
+        batch_tables["knights"] = knights
+        batch_tables["rays"] = rays
+        batch_tables["directions"] = numpy.array(BATCH_DIRECTIONS)
+    return batch_tables
+
+def packPositions(boards):
+    """
+    Packs boards, a list of ChessBoards or of lists of rows, into an
+    N x 12 x 64 array of piece planes: plane i is 1 on the squares
+    holding PLANE_PIECES[i].
+    """
+    if numpy is None:
+        raise ImportError("packPositions needs numpy")
+    text = "".join(["".join(["".join(row) for row in
+                             getattr(board, "board", board)])
+                    for board in boards])
+    codes = numpy.frombuffer(text.encode("ascii"), dtype=numpy.uint8)
+    codes = codes.reshape(len(boards), 1, 64)
+    pieces = numpy.frombuffer(PLANE_PIECES.encode("ascii"),
+                              dtype=numpy.uint8).reshape(1, 12, 1)
+    return (codes == pieces).astype(numpy.int8)
+
+def batchMobility(planes):
+    """
+    For N x 12 x 64 piece planes, returns the N numbers of squares
+    the white knights, bishops, rooks and queens can go to (empty or
+    holding a black piece, ignoring pins and checks) minus the same
+    for black.
+    """
+    tables = getBatchTables()
+    n = len(planes)
+    # with a padding column, square 64, that is never free:
+    pad = numpy.ones((n, 1), dtype=bool)
+    white = numpy.concatenate([planes[:, :6].any(axis=1), pad], axis=1)
+    black = numpy.concatenate([planes[:, 6:].any(axis=1), pad], axis=1)
+    taken = white | black
+    # only the squares that hold the pieces, by kind:
+    # N, B, R, Q, n, b, r, q
+    pos, kind, sq = numpy.nonzero(planes[:, [1, 2, 3, 4, 7, 8, 9, 10]])
+    is_black = kind >= 4
+    kind = kind % 4
+    sign = numpy.where(is_black, -1.0, 1.0)
+    # knights: targets not taken by their own side
+    own = numpy.where(is_black[:, None],
+                      black[pos[:, None], tables["knights"][sq]],
+                      white[pos[:, None], tables["knights"][sq]])
+    jumps = (~own).sum(axis=1)
+    # sliders: the empty squares along each ray, and the piece that
+    # stops it if it is the other side's
+    rays = tables["rays"][sq]
+    reach = taken[pos[:, None, None], rays].argmax(axis=2)
+    stop = rays[numpy.arange(len(sq))[:, None], numpy.arange(8), reach]
+    other = numpy.where(is_black[:, None], white[pos[:, None], stop],
+                        black[pos[:, None], stop])
+    other &= stop < 64
+    slides = ((reach + other) * tables["directions"][kind]).sum(axis=1)
+    moves = numpy.where(kind == 0, jumps, slides)
+    return numpy.bincount(pos, weights=sign * moves, minlength=n)
+
+def evaluateBatch(boards, players, profile="classic", mobility=0.0):
+    """
+    Scores N positions at once: boards is a list of ChessBoards or of
+    lists of rows, and players who each score is for. The score is
+    the material and piece-square value of the profile (the same as
+    Evaluator(profile) gives), plus mobility times batchMobility.
+    Returns an array of N scores. Needs numpy.
+    """
+    planes = packPositions(boards)
+    table = getEvalTable(profile)
+    weights = numpy.array([table[p] for p in PLANE_PIECES])
+    scores = numpy.tensordot(planes, weights, axes=([1, 2], [0, 1]))
+    if mobility:
+        scores = scores + mobility * batchMobility(planes)
+    signs = numpy.array([player == 'b' and -1 or 1 for player in players])
+    return scores * signs
+
+def scoreMoves(board, state, moves, profile="classic", mobility=0.0):
+    """
+    Scores every move in moves, the output of getMoves, for the player
+    making it, in one evaluateBatch call. Returns a list of (fromPos,
+    toPos, score).
+    """
+    tofrom = []
+    boards = []
+    for fromPos, piece, toList in moves:
+        for toPos in toList:
+            board.push(state, (fromPos, toPos))
+            boards.append(board.getBoard())
+            board.pop(state)
+            tofrom.append((fromPos, toPos))
+    scores = evaluateBatch(boards, [state.player] * len(boards), profile,
+                           mobility)
+    return [(fromPos, toPos, float(score))
+            for (fromPos, toPos), score in zip(tofrom, scores)]
+
+def batchPlayer(board, state, moves):
+    """
+    Like player1, but scores all of its moves in one batch, by the
+    "classic" profile and mobility, and picks among the best at
+    random. Needs numpy.
+    """
+    scored = scoreMoves(board, state, moves, "classic", 1.0)
+    best = max(score for fromPos, toPos, score in scored)
+    fromPos, toPos, score = random.choice(
+        [move for move in scored if move[2] == best])
+    return fromPos, toPos
+
+class TranspositionTable(object):
+    """
+    Search results keyed by position (State.getKey()), in arrays that
+    are allocated once to fit in size_mb megabytes. Entries are kept
+    in buckets of bucket_size; when a bucket is full, policy "depth"
+    keeps the deepest results and only replaces the last entry of the
+    bucket with shallower ones, and policy "always" replaces the
+    last entry every time.
+    """
+    # Bound types
+    EXACT = 0
+    LOWER = 1
+    UPPER = 2
+    # Bytes per entry: key, score and packed data
+    ENTRY_SIZE = 8 + 8 + 4
+    # Packed data: bits 0-5 from square, 6-11 to square, 12 has move,
+    # 13-14 bound type, 15-22 depth, 23 used
+    HAS_MOVE = 1 << 12
+    USED = 1 << 23
+
+    def __init__(self, size_mb=16, policy="depth", bucket_size=2):
+        if policy not in ("depth", "always"):
+            raise ValueError("unknown policy: '%s'" % policy)
+        self.policy = policy
+        self.bucket_size = bucket_size
+        self.buckets = max(1, int(size_mb * 1024 * 1024) //
+                           (self.ENTRY_SIZE * bucket_size))
+        self.size = self.buckets * bucket_size
+        self.clear()
+
+    def clear(self):
+        """
+        Empties the table and resets the statistics.
+        """
+        self.keys = array('Q', [0]) * self.size
+        self.scores = array('d', [0.0]) * self.size
+        self.data = array('I', [0]) * self.size
+        self.used = 0
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+        self.overwrites = 0
+
+    def probe(self, key):
+        """
+        Returns (depth, score, bound, move) stored for key, or None.
+        move is ((fx, fy), (tx, ty)) or None.
+        """
+        self.probes += 1
+        i = (key % self.buckets) * self.bucket_size
+        for i in range(i, i + self.bucket_size):
+            if self.keys[i] == key and self.data[i] & self.USED:
+                self.hits += 1
+                d = self.data[i]
+                move = None
+                if d & self.HAS_MOVE:
+                    f = d & 63
+                    t = (d >> 6) & 63
+                    move = ((f % 8, f // 8), (t % 8, t // 8))
+                return ((d >> 15) & 255, self.scores[i], (d >> 13) & 3, move)
+        return None
+
+    def store(self, key, depth, score, bound, move=None):
+        """
+        Saves a search result for key. depth is clipped to 0-255.
+        """
+        self.stores += 1
+        first = (key % self.buckets) * self.bucket_size
+        last = first + self.bucket_size - 1
+        slot = None
+        for i in range(first, last + 1):
+            if self.keys[i] == key and self.data[i] & self.USED:
+                slot = i
+                break
+        if slot is None:
+            for i in range(first, last + 1):
+                if not self.data[i] & self.USED:
+                    slot = i
+                    break
+        if slot is None:
+            slot = last
+            if self.policy == "depth":
+                for i in range(first, last):
+                    if (self.data[i] >> 15) & 255 <= depth:
+                        slot = i
+                        break
+            self.overwrites += 1
+        elif not self.data[slot] & self.USED:
+            self.used += 1
+        depth = min(max(depth, 0), 255)
+        d = self.USED | (depth << 15) | (bound << 13)
+        if move is not None:
+            (fx, fy), (tx, ty) = move[0], move[1]
+            d |= self.HAS_MOVE | (fy * 8 + fx) | ((ty * 8 + tx) << 6)
+        self.keys[slot] = key
+        self.scores[slot] = score
+        self.data[slot] = d
+
+    def hitRate(self):
+        """
+        Fraction of probes that found their position.
+        """
+        if not self.probes:
+            return 0.0
+        return self.hits / float(self.probes)
+
+    def fill(self):
+        """
+        Fraction of entries in use.
+        """
+        return self.used / float(self.size)
+
+    def getStats(self):
+        return {"size": self.size, "used": self.used,
+                "fill": self.fill(), "probes": self.probes,
+                "hits": self.hits, "hit_rate": self.hitRate(),
+                "stores": self.stores, "overwrites": self.overwrites}
+
+class SearchTimeout(Exception):
+    pass
+
+class MoveOrderer(object):
+    """
+    Puts moves in the order a search should try them: the hash move,
+    then captures and promotions, most valuable victim first and among
+    those the least valuable attacker first, then the killer moves of
+    the ply (quiet moves that caused a cutoff at that ply before),
+    then the other quiet moves by the history table (how much they
+    caused cutoffs anywhere). The search calls cutoff() whenever a
+    move causes one, which teaches the killers and history, and counts
+    how often it was the first move tried.
+    """
+    VALUES = {'P': 1, 'N': 3, 'B': 3, 'R': 5, 'Q': 9, 'K': 20}
+    # sort keys of each kind of move start at:
+    HASH = 3 << 30
+    CAPTURE = 2 << 30
+    KILLER = 1 << 30
+
+    def __init__(self, killers=2):
+        self.killer_slots = killers
+        self.killers = {}
+        self.history = {}
+        self.resetCounters()
+
+    def resetCounters(self):
+        self.cutoffs = 0
+        self.first_cutoffs = 0
+
+    def newSearch(self):
+        """
+        Forgets the killers, ages the history, and resets the counters.
+        """
+        self.killers = {}
+        for move in self.history:
+            self.history[move] //= 2
+        self.resetCounters()
+
+    def firstCutoffRate(self):
+        """
+        The share of cutoffs that came from the first move tried.
+        """
+        if not self.cutoffs:
+            return 0.0
+        return self.first_cutoffs / float(self.cutoffs)
+
+    def captureValue(self, board, fromPos, toPos):
+        """
+        Returns the MVV-LVA value of the move if it is a capture or
+        a promotion, else None.
+        """
+        piece = board.board[fromPos[1]][fromPos[0]].upper()
+        victim = board.board[toPos[1]][toPos[0]].upper()
+        if victim == ' ':
+            if piece != 'P':
+                return None
+            if toPos[1] == 0 or toPos[1] == 7:
+                victim = 'Q'
+            elif toPos[0] != fromPos[0]:
+                # en passant
+                victim = 'P'
+            else:
+                return None
+        return self.VALUES[victim] * 32 - self.VALUES[piece]
+
+    def order(self, board, state, moves, ply, hash_move=None):
+        """
+        Returns the (fromPos, toPos) moves of moves, the output of
+        getMoves, best first.
+        """
+        killers = self.killers.get(ply, [])
+        history = self.history
+        player = state.player
+        scored = []
+        for fromPos, piece, toList in moves:
+            for toPos in toList:
+                move = (fromPos, toPos)
+                if move == hash_move:
+                    key = self.HASH
+                else:
+                    value = self.captureValue(board, fromPos, toPos)
+                    if value is not None:
+                        key = self.CAPTURE + value
+                    elif move in killers:
+                        key = self.KILLER + len(killers) - killers.index(move)
+                    else:
+                        key = history.get((player, fromPos, toPos), 0)
+                scored.append((key, move))
+        scored.sort(key=lambda item: -item[0])
+        return [move for key, move in scored]
+
+    def cutoff(self, board, state, move, depth, ply, index):
+        """
+        Called with the board back before move, which caused a cutoff
+        searching depth plies at ply, and was tried index-th.
+        """
+        self.cutoffs += 1
+        if index == 0:
+            self.first_cutoffs += 1
+        fromPos, toPos = move[0], move[1]
+        if self.captureValue(board, fromPos, toPos) is not None:
+            return
+        killers = self.killers.setdefault(ply, [])
+        if move in killers:
+            killers.remove(move)
+        killers.insert(0, move)
+        del killers[self.killer_slots:]
+        key = (state.player, fromPos, toPos)
+        self.history[key] = min(self.history.get(key, 0) + depth * depth,
+                                self.KILLER - 1)
+
+class SearchPlayer(object):
+    """
+    A player that looks ahead with a negamax search and alpha-beta
+    pruning. It deepens one ply at a time, up to depth plies or until
+    time_limit seconds have been used, and plays the best move of the
+    deepest search it finished. depth can be None to search as deep
+    as time_limit allows. Use an instance like any player function,
+    eg play(randomPlayer2, SearchPlayer(depth=2)). The figures of each
+    iteration are kept in stats, and printed as well with verbose.
+    name is the __name__ it goes by, eg in tournament().
+
+    tt can be a TranspositionTable to share results between move
+    orders, iterations and moves. With ordering, moves are tried in
+    the order of a MoveOrderer, kept in the orderer attribute. With
+    quiescence, the positions at the end of the search are not scored
+    until the captures and promotions on the board are played out
+    (see quiesce).
+
+    Three selective techniques are off by default. With null_move,
+    a node first lets the other player move twice; if a search
+    null_reduction plies shallower still fails high, so will the real
+    one. It is not tried in check, or with only king and pawns left,
+    where passing can be the best move (zugzwang). With reductions,
+    the quiet moves after the first reduce_after of a node are
+    searched one ply shallower with a null window, and only searched
+    again at full depth if they beat alpha; this relies on ordering
+    to put the good moves first. With aspiration, a number, each
+    iteration searches a window of that many points around the score
+    of the last one, and the full window again if it falls outside.
+    """
+    MATE = 100000
+    # counters of the selective techniques, kept per search
+    PRUNING_COUNTERS = ("null_tries", "null_cutoffs", "reductions",
+                        "re_searches", "aspiration_fails")
+
+    def __init__(self, depth=3, time_limit=None, evaluate=staticAnalysis,
+                 verbose=False, tt=None, ordering=True, quiescence=True,
+                 null_move=False, null_reduction=2, reductions=False,
+                 reduce_after=3, aspiration=None, name="SearchPlayer"):
+        if depth is None and not time_limit:
+            raise ValueError("SearchPlayer needs a depth or a time_limit")
+        self.depth = depth
+        self.time_limit = time_limit
+        self.evaluate = evaluate
+        self.verbose = verbose
+        self.tt = tt
+        if ordering:
+            self.orderer = MoveOrderer()
+        else:
+            self.orderer = None
+        self.quiescence = quiescence
+        # sorts the captures of quiesce, also without ordering
+        self.captures = self.orderer or MoveOrderer()
+        self.null_move = null_move
+        self.null_reduction = null_reduction
+        self.reductions = reductions
+        self.reduce_after = reduce_after
+        self.aspiration = aspiration
+        self.__name__ = name
+        # one entry per iteration of the last search:
+        self.stats = []
+
+    def __call__(self, board, state, moves):
+        # moves is a list of [(from, piece, moves), ...]
+        tofrom = []
+        for move in moves:
+            fromPos = move[0]
+            for toPos in move[2]:
+                tofrom.append((fromPos, toPos))
+        return self.search(board, state, tofrom)
+
+    def search(self, board, state, tofrom):
+        """
+        Iterative deepening over the (fromPos, toPos) moves in tofrom.
+        Returns the best one. Each iteration adds a dictionary to stats;
+        its nodes and nps are those of the iteration alone, seconds is
+        the time since the search started.
+        """
+        self.stats = []
+        self.nodes = 0
+        self.qnodes = 0
+        self.pruning = dict((name, 0) for name in self.PRUNING_COUNTERS)
+        if self.orderer:
+            self.orderer.newSearch()
+        start = time.time()
+        if self.time_limit:
+            self.deadline = start + self.time_limit
+        else:
+            self.deadline = None
+        best = tofrom[0]
+        score = None
+        depth = 1
+        stack = len(state.push_stack)
+        while self.depth is None or depth <= self.depth:
+            began = time.time()
+            nodes = self.nodes
+            qnodes = self.qnodes
+            pruning = dict(self.pruning)
+            try:
+                score, move = self.searchWindow(board, state, tofrom, depth,
+                                                score)
+            except SearchTimeout:
+                while len(state.push_stack) > stack:
+                    board.pop(state)
+                break
+            best = move
+            # search the best move first next time:
+            tofrom.remove(move)
+            tofrom.insert(0, move)
+            now = time.time()
+            seconds = now - start
+            info = {"depth": depth, "score": score, "move": move,
+                    "nodes": self.nodes - nodes, "seconds": seconds,
+                    "nps": 0}
+            if now > began:
+                info["nps"] = int((self.nodes - nodes) / (now - began))
+            if self.tt:
+                info["tt_hit_rate"] = self.tt.hitRate()
+                info["tt_fill"] = self.tt.fill()
+            if self.orderer:
+                info["cutoffs"] = self.orderer.cutoffs
+                info["first_cutoff_rate"] = self.orderer.firstCutoffRate()
+            if self.quiescence:
+                info["qnodes"] = self.qnodes - qnodes
+            if self.null_move or self.reductions or self.aspiration:
+                for name in self.PRUNING_COUNTERS:
+                    info[name] = self.pruning[name] - pruning[name]
+            self.stats.append(info)
+            if self.verbose:
+                print("depth %(depth)d score %(score).1f move %(move)s "
+                      "nodes %(nodes)d nps %(nps)d" % info)
+                if self.tt:
+                    print("  tt hit rate %(tt_hit_rate).3f "
+                          "fill %(tt_fill).3f" % info)
+                if self.orderer:
+                    print("  cutoffs %(cutoffs)d first move "
+                          "%(first_cutoff_rate).3f" % info)
+                if self.quiescence:
+                    print("  quiescence nodes %(qnodes)d" % info)
+                if self.null_move or self.reductions or self.aspiration:
+                    print("  null move cutoffs %(null_cutoffs)d of "
+                          "%(null_tries)d reductions %(reductions)d "
+                          "re-searches %(re_searches)d aspiration fails "
+                          "%(aspiration_fails)d" % info)
+            if abs(score) >= self.MATE - 1000:
+                break
+            if self.deadline and now > self.deadline:
+                break
+            depth += 1
+        return best
+
+    def searchWindow(self, board, state, tofrom, depth, last=None):
+        """
+        Searches the root depth plies deep, within the aspiration
+        window around last, the score of the previous iteration, if
+        there is one, and again with the full window if the score
+        falls outside it. Returns (score, move).
+        """
+        if self.aspiration and last is not None:
+            alpha = last - self.aspiration
+            beta = last + self.aspiration
+            score, move = self.searchRoot(board, state, tofrom, depth,
+                                          alpha, beta)
+            if alpha < score < beta:
+                return score, move
+            self.pruning["aspiration_fails"] += 1
+        return self.searchRoot(board, state, tofrom, depth)
+
+    def searchRoot(self, board, state, tofrom, depth,
+                   alpha=-MATE - 1, beta=MATE + 1):
+        best = tofrom[0]
+        best_score = -self.MATE - 1
+        for move in tofrom:
+            board.push(state, move)
+            score = -self.negamax(board, state, depth - 1, -beta, -alpha, 1)
+            board.pop(state)
+            if score > best_score:
+                best_score = score
+                best = move
+                if score > alpha:
+                    alpha = score
+                    if score >= beta:
+                        break
+        return best_score, best
+
+    def negamax(self, board, state, depth, alpha, beta, ply, null_ok=True):
+        """
+        Returns the score of the position for state.player, searched
+        depth plies deep, within the alpha-beta window. null_ok is
+        False right after a null move, so that two are not made in a
+        row.
+        """
+        # a draw by the fifty-move rule, or a repetition, which the
+        # player to move could repeat again
+        if state.stasis_count >= 100 or state.isRepeated():
+            return 0
+        if depth <= 0 and self.quiescence:
+            return self.quiesce(board, state, alpha, beta, ply)
+        self.nodes += 1
+        if self.deadline and not self.nodes & 255:
+            if time.time() > self.deadline:
+                raise SearchTimeout()
+        if depth <= 0:
+            player = state.player
+            score = self.evaluate(board, state)
+            state.player = player
+            return score
+        hash_move = None
+        if self.tt:
+            key = state.getKey()
+            entry = self.tt.probe(key)
+            if entry:
+                tdepth, score, bound, hash_move = entry
+                if tdepth >= depth:
+                    score = self.fromTable(score, ply)
+                    tt = self.tt
+                    if (bound == tt.EXACT or
+                        (bound == tt.LOWER and score >= beta) or
+                        (bound == tt.UPPER and score <= alpha)):
+                        return score
+        check = None
+        if self.null_move or self.reductions:
+            check = board.isCheck(state)
+        if (self.null_move and null_ok and not check and
+            depth > self.null_reduction and beta < self.MATE - 1000 and
+            self.hasPieces(board, state.player)):
+            self.pruning["null_tries"] += 1
+            score = -self.nullSearch(board, state, depth, beta, ply)
+            if score >= beta:
+                self.pruning["null_cutoffs"] += 1
+                return beta
+        moves = board.getMoves(state)
+        if not moves:
+            if check is None:
+                check = board.isCheck(state)
+            if check:
+                return -self.MATE + ply
+            return 0
+        if self.orderer:
+            tofrom = self.orderer.order(board, state, moves, ply, hash_move)
+        else:
+            tofrom = []
+            for fromPos, piece, toList in moves:
+                for toPos in toList:
+                    tofrom.append((fromPos, toPos))
+            if hash_move in tofrom:
+                tofrom.remove(hash_move)
+                tofrom.insert(0, hash_move)
+        alpha0 = alpha
+        best = -self.MATE - 1
+        best_move = None
+        killers = ()
+        if self.orderer:
+            killers = self.orderer.killers.get(ply, ())
+        for index, move in enumerate(tofrom):
+            late = (self.reductions and not check and depth >= 3 and
+                      index >= self.reduce_after and move not in killers and
+                      self.captures.captureValue(board, move[0],
+                                                 move[1]) is None)
+            board.push(state, move)
+            if late and not board.isCheck(state):
+                # a late quiet move: try to show it is no better than
+                # alpha with a shallower null window search first
+                self.pruning["reductions"] += 1
+                score = -self.negamax(board, state, depth - 2,
+                                      -alpha - 1, -alpha, ply + 1)
+                if score > alpha:
+                    self.pruning["re_searches"] += 1
+                    score = -self.negamax(board, state, depth - 1,
+                                          -beta, -alpha, ply + 1)
+            else:
+                score = -self.negamax(board, state, depth - 1,
+                                      -beta, -alpha, ply + 1)
+            board.pop(state)
+            if score > best:
+                best = score
+                best_move = move
+                if score > alpha:
+                    alpha = score
+                    if score >= beta:
+                        if self.orderer:
+                            self.orderer.cutoff(board, state, move, depth,
+                                                ply, index)
+                        break
+        if self.tt:
+            if best >= beta:
+                bound = self.tt.LOWER
+            elif best > alpha0:
+                bound = self.tt.EXACT
+            else:
+                bound = self.tt.UPPER
+            self.tt.store(key, depth, self.toTable(best, ply), bound,
+                          best_move)
+        return best
+
+    def nullSearch(self, board, state, depth, beta, ply):
+        """
+        Passes the turn to the other player and returns their score,
+        searched null_reduction plies shallower than a move would be,
+        with a null window just under -beta.
+        """
+        player = state.player
+        ep = state.ep[1]
+        state.player = board.getOtherPlayer(state)
+        state.ep[1] = 0
+        state.push_keys.append(state.getKey())
+        try:
+            return self.negamax(board, state, depth - 1 - self.null_reduction,
+                                -beta, -beta + 1, ply + 1, False)
+        finally:
+            state.push_keys.pop()
+            state.player = player
+            state.ep[1] = ep
+
+    def hasPieces(self, board, color):
+        """
+        Returns True if color has more than king and pawns, so that
+        a null move is unlikely to hide a zugzwang.
+        """
+        for x, y in board.getPieces(color):
+            if board.board[y][x].upper() not in "KP":
+                return True
+        return False
+
+    def quiesce(self, board, state, alpha, beta, ply):
+        """
+        Returns the score of the position for state.player, searching
+        only captures and promotions until none are left that do not
+        lose material by static exchange, and taking the evaluation
+        when that is better (standing pat). In check, all the moves
+        are searched instead, as standing pat is no option there.
+        """
+        self.nodes += 1
+        self.qnodes += 1
+        if self.deadline and not self.nodes & 255:
+            if time.time() > self.deadline:
+                raise SearchTimeout()
+        check = board.isCheck(state)
+        if check:
+            best = -self.MATE - 1
+        else:
+            player = state.player
+            best = self.evaluate(board, state)
+            state.player = player
+            if best >= beta:
+                return best
+            if best > alpha:
+                alpha = best
+        moves = board.getMoves(state)
+        if not moves:
+            if check:
+                return -self.MATE + ply
+            return 0
+        scored = []
+        for fromPos, piece, toList in moves:
+            for toPos in toList:
+                value = self.captures.captureValue(board, fromPos, toPos)
+                if value is None:
+                    if not check:
+                        continue
+                    value = -1
+                elif not check and (piece.upper() != 'P' or toPos[1] % 7):
+                    # a losing capture, unless it promotes
+                    if board.staticExchange(state, fromPos, toPos) < 0:
+                        continue
+                scored.append((value, (fromPos, toPos)))
+        scored.sort(key=lambda item: -item[0])
+        for value, move in scored:
+            board.push(state, move)
+            score = -self.quiesce(board, state, -beta, -alpha, ply + 1)
+            board.pop(state)
+            if score > best:
+                best = score
+                if score > alpha:
+                    alpha = score
+                    if score >= beta:
+                        break
+        return best
+
+    def toTable(self, score, ply):
+        # Mate scores count plies from the root; the table keeps them
+        # relative to the position instead.
+        if score >= self.MATE - 1000:
+            return score + ply
+        if score <= -self.MATE + 1000:
+            return score - ply
+        return score
+
+    def fromTable(self, score, ply):
+        if score >= self.MATE - 1000:
+            return score - ply
+        if score <= -self.MATE + 1000:
+            return score + ply
+        return score
+
+def playTournamentGame(job):
+    """
+    Plays one tournament game in a worker process. job is (black
+    index, white index, black player, white player, seed, backend,
+    max_plies).
+    """
+    black, white, player1, player2, seed, backend, max_plies = job
+    random.seed(seed)
+    game = playQuiet(player1, player2, max_plies, backend)
+    return black, white, game.result
+
+def tournament(players, games=10, processes=None, seed=None, backend=None,
+               max_plies=None):
+    """
+    Plays every player against every other one, games times with each
+    color (or a single player against itself), spread over a pool of
+    processes. Players must be picklable: module level functions or
+    SearchPlayer instances. Game i is seeded with seed + i, so a
+    tournament can be replayed. Games cut off at max_plies count as
+    draws, under RUNNING. Prints and returns a summary with win, draw
+    and loss counts for each player, and counts by result code.
+    Players are named by their __name__, with #1, #2, ... (their
+    place in players) added to names that would otherwise repeat.
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+    if len(players) == 1:
+        pairs = [(0, 0)]
+    else:
+        pairs = [(b, w) for b in range(len(players))
+                 for w in range(len(players)) if b != w]
+    jobs = []
+    for black, white in pairs:
+        for i in range(games):
+            jobs.append((black, white, players[black], players[white],
+                         seed + len(jobs), backend, max_plies))
+    names = []
+    for i, player in enumerate(players):
+        name = player.__name__
+        if [p.__name__ for p in players].count(name) > 1:
+            # eg two SearchPlayers: tell them apart by their position
+            name = "%s#%d" % (name, i + 1)
+        names.append(name)
+    scores = [{"win": 0, "draw": 0, "loss": 0} for player in players]
+    results = {}
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for black, white, result in pool.imap_unordered(playTournamentGame,
+                                                        jobs):
+            name = REASON_NAMES.get(result, str(result))
+            results[name] = results.get(name, 0) + 1
+            if result == ChessBoard.WHITE_WIN:
+                scores[white]["win"] += 1
+                scores[black]["loss"] += 1
+            elif result == ChessBoard.BLACK_WIN:
+                scores[black]["win"] += 1
+                scores[white]["loss"] += 1
+            else:
+                scores[black]["draw"] += 1
+                scores[white]["draw"] += 1
+    finally:
+        pool.close()
+        pool.join()
+    seconds = time.time() - start
+    print("%d games in %.1fs, %.2f games/s" % (
+        len(jobs), seconds, len(jobs) / seconds))
+    for name, score in zip(names, scores):
+        print("%-20s win %5d draw %5d loss %5d" % (
+            name, score["win"], score["draw"], score["loss"]))
+    for name in sorted(results):
+        print("%-25s %5d" % (name, results[name]))
+    return {"games": len(jobs), "seconds": seconds, "seed": seed,
+            "players": dict(zip(names, scores)), "results": results}
+
+# Reference positions with their known move path counts, by depth:
+PERFT_POSITIONS = [
+    ("start", "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+     [20, 400, 8902, 197281]),
+    ("kiwipete",
+     "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     [48, 2039, 97862]),
+    ("en passant", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     [14, 191, 2812, 43238]),
+    ("promotion",
+     "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+     [6, 264, 9467]),
+    ("castling",
+     "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+     [44, 1486, 62379]),
+    ]
+
+def makePosition(fen, backend=None):
+    """
+    Returns a (board, state) pair set up from a FEN string.
+    """
+    board = ChessBoard(backend)
+    state = State('w')
+    board.setFEN(state, fen)
+    return board, state
+
+def perftCount(board, state, depth):
+    """
+    Counts the move paths depth plies deep from the position, with
+    each promotion counted once per promotion piece.
+    """
+    nodes = 0
+    for fromPos, piece, toList in board.getMoves(state):
+        for toPos in toList:
+            if piece in 'Pp' and toPos[1] in (0, 7):
+                promotions = (1, 2, 3, 4)
+            else:
+                promotions = (None,)
+            if depth == 1:
+                nodes += len(promotions)
+                continue
+            for promotion in promotions:
+                if promotion:
+                    board.push(state, (fromPos, toPos, promotion))
+                else:
+                    board.push(state, (fromPos, toPos))
+                nodes += perftCount(board, state, depth - 1)
+                board.pop(state)
+    return nodes
+
+def perft(depth, fen=PERFT_POSITIONS[0][1], backend=None, divide=False,
+          verbose=True):
+    """
+    Counts the move paths depth plies deep from the FEN position (the
+    start position by default) and reports the speed in nodes per
+    second. With divide, the count is also given per first move, to
+    narrow down a wrong total. Returns the total.
+    """
+    board, state = makePosition(fen, backend)
+    files = "abcdefgh"
+    ranks = "87654321"
+    start = time.time()
+    if divide and depth > 0:
+        nodes = 0
+        for fromPos, piece, toList in board.getMoves(state):
+            for toPos in toList:
+                if piece in 'Pp' and toPos[1] in (0, 7):
+                    promotions = ((1, "q"), (2, "r"), (3, "n"), (4, "b"))
+                else:
+                    promotions = ((None, ""),)
+                for promotion, letter in promotions:
+                    if promotion:
+                        board.push(state, (fromPos, toPos, promotion))
+                    else:
+                        board.push(state, (fromPos, toPos))
+                    if depth > 1:
+                        count = perftCount(board, state, depth - 1)
+                    else:
+                        count = 1
+                    board.pop(state)
+                    if verbose:
+                        print("%s%s%s%s%s: %d" % (
+                            files[fromPos[0]], ranks[fromPos[1]],
+                            files[toPos[0]], ranks[toPos[1]], letter, count))
+                    nodes += count
+    elif depth > 0:
+        nodes = perftCount(board, state, depth)
+    else:
+        nodes = 1
+    seconds = time.time() - start
+    if verbose:
+        print("perft(%d) = %d in %.2fs, %d nodes/s" % (
+            depth, nodes, seconds, nodes / seconds if seconds else 0))
+    return nodes
+
+def perftSuite(max_depth=3, backend=None):
+    """
+    Runs perft on the reference positions up to max_depth and checks
+    the counts. Returns True if they are all right.
+    """
+    ok = True
+    for name, fen, counts in PERFT_POSITIONS:
+        for depth in range(1, min(max_depth, len(counts)) + 1):
+            start = time.time()
+            nodes = perft(depth, fen, backend, verbose=False)
+            seconds = time.time() - start
+            if nodes == counts[depth - 1]:
+                result = "ok"
+            else:
+                result = "FAIL (expected %d)" % counts[depth - 1]
+                ok = False
+            print("%-10s depth %d: %8d nodes %8d nodes/s %s" % (
+                name, depth, nodes, nodes / seconds if seconds else 0,
+                result))
+    return ok
+
+def benchmarkMakeMove(plies=400, games=5, bucket=50, backend=None):
+    """
+    Plays random games of up to plies halfmoves, timing each call to
+    makeMove, and prints the average time per move for every bucket
+    of plies. The times should stay flat as the game gets longer.
+    Returns a list of (first ply, microseconds per move).
+    """
+    buckets = [[0.0, 0] for i in range((plies + bucket - 1) // bucket)]
+    for game in range(games):
+        state = State('w')
+        board = ChessBoard(backend)
+        for ply in range(plies):
+            moves = board.getMoves(state)
+            if not moves:
+                break
+            fromPos, toPos = randomPlayer2(board, state, moves)
+            start = time.time()
+            board.makeMove(state, fromPos, toPos)
+            b = buckets[ply // bucket]
+            b[0] += time.time() - start
+            b[1] += 1
+            state.player = board.getOtherPlayer(state)
+    results = []
+    print(" plies       usec/move")
+    for i, (total, count) in enumerate(buckets):
+        if not count:
+            break
+        usec = total / count * 1000000
+        print("%4d-%-4d  %10.1f" % (i * bucket + 1, (i + 1) * bucket, usec))
+        results.append((i * bucket + 1, usec))
+    return results
+
+#-----------------------------------------------------------------------
+# PGN
+#-----------------------------------------------------------------------
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# The tags that every exported game has, in this order:
+SEVEN_TAG_ROSTER = [("Event", "?"), ("Site", "?"), ("Date", "????.??.??"),
+                    ("Round", "?"), ("White", "?"), ("Black", "?"),
+                    ("Result", "*")]
+
+PGN_RESULTS = {
+    ChessBoard.WHITE_WIN: "1-0",
+    ChessBoard.BLACK_WIN: "0-1",
+    ChessBoard.STALEMATE: "1/2-1/2",
+    ChessBoard.STASIS_COUNT_LIMIT_RULE: "1/2-1/2",
+    ChessBoard.THREE_REPETITION_RULE: "1/2-1/2",
+    }
+
+# Movetext tokens: a comment (possibly running on past the line),
+# a rest-of-line comment, a variation bracket, a NAG, or anything else.
+PGN_TOKEN = re.compile(r"\{[^}]*\}?|;.*|[()]|\$\d+|[^\s{}();$]+")
+PGN_MOVE_NUMBER = re.compile(r"\d+\.+")
+
+class PGNGame(object):
+    """
+    One game of a PGN file: tags, a dict of the tag pairs in file
+    order, moves, the moves in SAN, and result, the termination marker
+    ("1-0", "0-1", "1/2-1/2" or "*").
+    """
+    def __init__(self, tags=None, moves=None, result="*"):
+        self.tags = tags or {}
+        self.moves = moves or []
+        self.result = result
+
+    def __repr__(self):
+        return "<PGNGame %s - %s %s, %d plies>" % (
+            self.tags.get("White", "?"), self.tags.get("Black", "?"),
+            self.result, len(self.moves))
+
+def readPGN(f):
+    """
+    Reads PGN games from f, an open file or any other iterable of
+    lines, and yields a PGNGame for each one as soon as it has been
+    read, so that memory use does not grow with the file. Comments,
+    variations and numeric annotation glyphs are dropped.
+    """
+    game = None
+    comment = False
+    depth = 0
+    for line in f:
+        if comment:
+            end = line.find("}")
+            if end < 0:
+                continue
+            line = line[end + 1:]
+            comment = False
+        elif line.startswith("%"):
+            continue
+        text = line.strip()
+        if text.startswith("[") and depth == 0:
+            if game is not None and game.moves:
+                # a game that ended without a result
+                yield game
+                game = None
+            if game is None:
+                game = PGNGame()
+            tag = text[1:].rstrip("]").split(None, 1)
+            if len(tag) == 2:
+                value = tag[1].strip()
+                if value.startswith('"'):
+                    value = value[1:-1]
+                game.tags[tag[0]] = value.replace('\\"', '"').replace(
+                    "\\\\", "\\")
+            continue
+        for token in PGN_TOKEN.findall(text):
+            if token[0] == "{":
+                comment = not token.endswith("}")
+            elif token[0] in ";$":
+                continue
+            elif token == "(":
+                depth += 1
+            elif token == ")":
+                depth = max(depth - 1, 0)
+            elif depth:
+                continue
+            elif token in ("1-0", "0-1", "1/2-1/2", "*"):
+                if game is None:
+                    game = PGNGame()
+                game.result = token
+                yield game
+                game = None
+            else:
+                number = PGN_MOVE_NUMBER.match(token)
+                if number:
+                    token = token[number.end():]
+                token = token.rstrip("!?")
+                if token:
+                    if game is None:
+                        game = PGNGame()
+                    game.moves.append(token)
+    if game is not None and (game.moves or game.tags):
+        yield game
+
+def writePGN(f, game):
+    """
+    Writes a PGNGame to f, an open file: the seven tag roster and the
+    other tags, then the moves with move numbers, in lines of at most
+    79 characters.
+    """
+    tags = dict(game.tags)
+    tags["Result"] = game.result
+    names = [name for name, default in SEVEN_TAG_ROSTER]
+    names += [name for name in tags if name not in names]
+    for name, default in SEVEN_TAG_ROSTER:
+        tags.setdefault(name, default)
+    for name in names:
+        value = str(tags[name]).replace("\\", "\\\\").replace('"', '\\"')
+        f.write('[%s "%s"]\n' % (name, value))
+    f.write("\n")
+    fields = tags.get("FEN", START_FEN).split()
+    black = len(fields) > 1 and fields[1] == 'b'
+    number = 1
+    if len(fields) > 5:
+        number = int(fields[5])
+    tokens = []
+    for san in game.moves:
+        if not black:
+            tokens.append("%d. %s" % (number, san))
+        elif not tokens:
+            tokens.append("%d... %s" % (number, san))
+        else:
+            tokens.append(san)
+        if black:
+            number += 1
+        black = not black
+    tokens.append(game.result)
+    line = ""
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > 79:
+            f.write(line + "\n")
+            line = ""
+        if line:
+            line += " "
+        line += token
+    f.write(line + "\n\n")
+
+def replayPGN(game, backend=None, visit=None):
+    """
+    Plays the moves of a PGNGame from its FEN tag, or from the start,
+    on a new board. Returns (board, state) at the end of the game.
+    Raises ValueError for a bad FEN tag, or a move that is not legal
+    in its position. visit, if given, is called as visit(board, state,
+    ply) after each move, with state.player to move next.
+    """
+    board = ChessBoard(backend)
+    state = State('w')
+    if "FEN" in game.tags:
+        board.setFEN(state, game.tags["FEN"])
+    for ply, san in enumerate(game.moves):
+        if not board.addTextMove(state, san):
+            raise ValueError("ply %d, '%s': %s" % (
+                ply + 1, san, REASON_NAMES.get(state.reason, state.reason)))
+        state.player = board.getOtherPlayer(state)
+        if board.isCheck(state):
+            state.setCheck("+")
+        if visit:
+            visit(board, state, ply)
+    if game.moves:
+        board.checkStatus(state, verbose=False)
+    return board, state
+
+def makePGNGame(board, state, tags=None):
+    """
+    Returns a PGNGame of the moves in the state history, with tags, a
+    dict, added to its tags, ready for writePGN. The result comes from
+    the state if the game is over, else from a "Result" tag. The board
+    and state are back where they were afterwards.
+    """
+    point = state.getCurrentMove()
+    state.gotoMove(board.board, 0)
+    game = PGNGame(dict(tags or {}))
+    fen = board.getFEN(state)
+    if fen != START_FEN:
+        game.tags["SetUp"] = "1"
+        game.tags["FEN"] = fen
+    state.gotoLast(board.board)
+    game.result = PGN_RESULTS.get(state.game_result,
+                                  game.tags.get("Result", "*"))
+    state.gotoMove(board.board, point)
+    game.moves = state.getAllMoves(board, board.SAN) or []
+    return game
+
+def findGameStart(f, offset):
+    """
+    Returns the byte offset of the first game in f, a PGN file opened
+    in binary mode, that starts after offset (or the file size if
+    there is none). A game starts with a tag line that follows a
+    line of movetext.
+    """
+    f.seek(offset)
+    pos = offset + len(f.readline())
+    # the line cut in half may have been a tag
+    after_tag = True
+    while True:
+        line = f.readline()
+        if not line:
+            return pos
+        if line.startswith(b"[") and not after_tag:
+            return pos
+        if line.strip():
+            after_tag = line.startswith(b"[")
+        pos += len(line)
+
+def findPGNShards(path, chunk_bytes):
+    """
+    Splits a PGN file into (start, end) byte ranges of about
+    chunk_bytes each that begin and end on game boundaries.
+    """
+    size = os.path.getsize(path)
+    starts = [0]
+    with open(path, "rb") as f:
+        while starts[-1] + chunk_bytes < size:
+            start = findGameStart(f, starts[-1] + chunk_bytes)
+            if start >= size:
+                break
+            starts.append(start)
+    return list(zip(starts, starts[1:] + [size]))
+
+def readPGNRange(path, start, end):
+    """
+    Yields the lines of a PGN file from byte start up to byte end.
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            pos += len(line)
+            yield line.decode("utf-8", "replace")
+
+def newCorpusStats():
+    """
+    Returns empty corpus statistics: game, error and ply counts,
+    counts by result and by opening (the first moves, as one string),
+    per ply the sum and count of staticAnalysis scores from white's
+    side, and up to CORPUS_ERROR_SAMPLES of the games that could not
+    be replayed, each a dictionary with the game's tags and the error
+    (which names the ply and SAN of a bad move).
+    """
+    return {"games": 0, "errors": 0, "plies": 0, "results": {},
+            "openings": {}, "eval_sum": [], "eval_count": [],
+            "error_samples": []}
+
+CORPUS_ERROR_SAMPLES = 10
+
+def mergeCorpusStats(total, part):
+    """
+    Adds the corpus statistics part into total.
+    """
+    for name in ("games", "errors", "plies"):
+        total[name] += part[name]
+    for name in ("results", "openings"):
+        counts = total[name]
+        for key, count in part[name].items():
+            counts[key] = counts.get(key, 0) + count
+    for ply in range(len(part["eval_sum"])):
+        if ply == len(total["eval_sum"]):
+            total["eval_sum"].append(0.0)
+            total["eval_count"].append(0)
+        total["eval_sum"][ply] += part["eval_sum"][ply]
+        total["eval_count"][ply] += part["eval_count"][ply]
+    samples = total.setdefault("error_samples", [])
+    for sample in part.get("error_samples", []):
+        if len(samples) < CORPUS_ERROR_SAMPLES:
+            samples.append(sample)
+    return total
+
+def analyzePGNShard(job):
+    """
+    Replays the games of one shard of a PGN file in a worker process
+    and gathers their statistics. job is (shard index, path, start,
+    end, opening plies, trajectory plies, backend). Games that cannot
+    be replayed (see replayPGN) count as errors, and the first few are
+    kept as samples.
+    """
+    index, path, start, end, opening_plies, trajectory_plies, backend = job
+    stats = newCorpusStats()
+    for game in readPGN(readPGNRange(path, start, end)):
+        scores = []
+        def visit(board, state, ply):
+            if ply < trajectory_plies:
+                # staticAnalysis leaves state.player changed
+                player = state.player
+                score = staticAnalysis(board, state)
+                state.player = player
+                if player == 'b':
+                    score = -score
+                scores.append(score)
+        try:
+            replayPGN(game, backend, visit)
+        except ValueError as error:
+            stats["errors"] += 1
+            if len(stats["error_samples"]) < CORPUS_ERROR_SAMPLES:
+                stats["error_samples"].append({"shard": index,
+                                               "tags": game.tags,
+                                               "error": str(error)})
+            continue
+        stats["games"] += 1
+        stats["plies"] += len(game.moves)
+        results = stats["results"]
+        results[game.result] = results.get(game.result, 0) + 1
+        if opening_plies and "FEN" not in game.tags:
+            opening = " ".join(game.moves[:opening_plies])
+            stats["openings"][opening] = stats["openings"].get(opening, 0) + 1
+        for ply, score in enumerate(scores):
+            if ply == len(stats["eval_sum"]):
+                stats["eval_sum"].append(0.0)
+                stats["eval_count"].append(0)
+            stats["eval_sum"][ply] += score
+            stats["eval_count"][ply] += 1
+    return index, stats
+
+def analyzeCorpus(path, processes=None, chunk_mb=4, progress=None,
+                  opening_plies=6, trajectory_plies=40, backend=None,
+                  verbose=True):
+    """
+    Replays every game of a PGN file with makeMove, spread over a pool
+    of processes that each read their own byte range (shard) of the
+    file, and merges their statistics (see newCorpusStats). If a
+    progress file name is given, the statistics so far and the shards
+    done are saved there as JSON after every shard, and a later call
+    with the same file and settings carries on where it stopped.
+    Prints (if verbose) and returns a summary with the statistics,
+    the average game length, the average score by ply and the games
+    per second of this run.
+    """
+    settings = {"path": os.path.abspath(path),
+                "size": os.path.getsize(path),
+                "chunk_mb": chunk_mb, "opening_plies": opening_plies,
+                "trajectory_plies": trajectory_plies}
+    saved = None
+    if progress and os.path.exists(progress):
+        with open(progress) as f:
+            saved = json.load(f)
+        if saved["settings"] != settings:
+            saved = None
+    if saved:
+        shards = saved["shards"]
+        done = set(saved["done"])
+        stats = saved["stats"]
+    else:
+        shards = findPGNShards(path, int(chunk_mb * 1024 * 1024))
+        done = set()
+        stats = newCorpusStats()
+    jobs = [(i, path, start, end, opening_plies, trajectory_plies, backend)
+            for i, (start, end) in enumerate(shards) if i not in done]
+    games = stats["games"] + stats["errors"]
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for index, part in pool.imap_unordered(analyzePGNShard, jobs):
+            mergeCorpusStats(stats, part)
+            done.add(index)
+            if progress:
+                with open(progress + ".tmp", "w") as f:
+                    json.dump({"settings": settings, "shards": shards,
+                               "done": sorted(done), "stats": stats}, f)
+                os.replace(progress + ".tmp", progress)
+    finally:
+        pool.close()
+        pool.join()
+    seconds = time.time() - start
+    games = stats["games"] + stats["errors"] - games
+    summary = {"stats": stats, "seconds": seconds,
+               "games_per_second": games / max(seconds, 1e-9),
+               "average_plies": stats["plies"] / max(stats["games"], 1),
+               "trajectory": [total / count for total, count in
+                              zip(stats["eval_sum"], stats["eval_count"])]}
+    if verbose:
+        print("%d games in %.1fs, %.2f games/s (%d shards, %d resumed)" % (
+            games, seconds, summary["games_per_second"], len(shards),
+            len(shards) - len(jobs)))
+        print("%d games, %d errors, %.1f plies on average" % (
+            stats["games"], stats["errors"], summary["average_plies"]))
+        for sample in stats.get("error_samples", []):
+            print("  error in %s: %s" % (
+                sample["tags"].get("Event", "?"), sample["error"]))
+        for result in sorted(stats["results"]):
+            print("%-10s %8d" % (result, stats["results"][result]))
+        openings = sorted(stats["openings"].items(),
+                          key=lambda item: -item[1])
+        for opening, count in openings[:10]:
+            print("%8d  %s" % (count, opening))
+        for ply in range(0, len(summary["trajectory"]), 10):
+            print("ply %3d  %8.1f" % (ply + 1, summary["trajectory"][ply]))
+    return summary
+
 if __name__ == "__main__":
     # Play a game:
     # black, white: